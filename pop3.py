@@ -2,159 +2,546 @@ import socket
 import ssl
 import re
 import base64
+import binascii
+import json
+import os
+from itertools import islice
+from urllib.parse import unquote_to_bytes
 from argparse import ArgumentParser
 
-HEADER_RE_TEXT = r'(?:(?:^)|(?:\r\n)){}: ([^\r]+)\r\n((?:\s+[^\r]+\r\n)*)'
-HEADER_RES = [
-    re.compile(HEADER_RE_TEXT.format('Date').encode('ascii')),
-    re.compile(HEADER_RE_TEXT.format('To').encode('ascii')),
-    re.compile(HEADER_RE_TEXT.format('From').encode('ascii')),
-    re.compile(HEADER_RE_TEXT.format('Subject').encode('ascii'))
-]
-HEADER_TEXT_RE = re.compile(rb'\s*([^\r]+)\r\n')
-MIME_RE = re.compile(rb'=\?([^?]+)\?([^?]+)\?([^?]+)\?=')
-MIME_SYM_RE = re.compile(rb'=([A-F0-9]{2})')
-BOUNDARY_RE = re.compile(rb'--[^\r]+\r\n')
-ATTACH_FILENAME = re.compile(
-    rb'Content-Disposition: attachment;[^f]+filename="([^"]+)"'
-)
-WHITESPACE_RE = re.compile(rb'\r\n\s+([^\r\n])')
-ATTACH_CONTENT_RE = re.compile(rb'\r\n\r\n([^-]+)(?:--)|(?:$)', flags=re.DOTALL)
+HEADER_RE = re.compile(rb'^([^:\s]+):[ \t]*([^\r\n]*(?:\r\n[ \t][^\r\n]*)*)', flags=re.M)
+FOLD_RE = re.compile(rb'\r\n(?=[ \t])')
+PARAM_RE = re.compile(rb';\s*([^\s=;]+)\s*=\s*(?:"((?:[^"\\]|\\.)*)"|([^\s;]*))')
+QUOTED_PAIR_RE = re.compile(rb'\\(.)')
+# имя*N* - часть N значения в кодировке из RFC 2231
+EXTENDED_PARAM_RE = re.compile(r'([^*]+)\*(\d+)?(\*)?$')
+MIME_RE = re.compile(rb'=\?([^?]+)\?([^?]+)\?([^?]*)\?=')
+MAIN_FIELDS = ('date', 'to', 'from', 'subject')
 DEFAULT_ENCODING = 'utf-8'
 SSL_PORT = 995
+RECV_SIZE = 65536
+# сколько команд держать без ответа при PIPELINING
+PIPELINE_DEPTH = 16
 
 class POP3Exception(Exception):
     pass
 
 class MailInfo(object):
-    def __init__(self, num, from_, to, subject, date, attaches):
+    def __init__(self, num, from_, to, subject, date, attaches, size=None,
+                 partial=False):
         self.num = num
+        # размер письма по LIST
+        self.size = size
+        # письмо получено не целиком, аттачей может быть больше
+        self.partial = partial
         self.from_ = from_
         self.to = to
         self.subject = subject
         self.date = date
         self.attaches = attaches
 
+    def as_dict(self):
+        '''
+        Представление для машиночитаемого вывода.
+        '''
+        return {
+            'num': self.num,
+            'size': self.size,
+            'date': self.date,
+            'to': self.to,
+            'from': self.from_,
+            'subject': self.subject,
+            'attachments': self.attaches,
+            'partial': self.partial
+        }
+
+def decode(data, charset):
+    try:
+        return bytes(data).decode(charset, 'replace')
+    except LookupError:
+        return bytes(data).decode(DEFAULT_ENCODING, 'replace')
+
 def unmime(data):
     '''
-    Декодирует байты в MIME формате.
-    '''
-    res = bytearray(data).replace(b'_', b' ')
-    charset = DEFAULT_ENCODING
-    while True:
-        match = MIME_RE.search(res)
-        if not match:
-            break
-        enc = match.group(2)
-        charset = match.group(1).decode('ascii')
-        text = bytearray(match.group(3))
-        if enc == b'q' or enc == b'Q':
-            while True:
-                sym = MIME_SYM_RE.search(text)
-                if not sym:
-                    break
-                text[sym.start():sym.end()] = [int(sym.group(1), 16)]
+    Декодирует байты с MIME словами (RFC 2047) за один проход. Пробелы
+    между соседними MIME словами отбрасываются.
+    '''
+    res = []
+    pos = 0
+    for match in MIME_RE.finditer(data):
+        text = data[pos:match.start()]
+        if not (pos and text.isspace()):
+            res.append(decode(text, DEFAULT_ENCODING))
+        charset, enc, text = match.groups()
+        try:
+            if enc in (b'q', b'Q'):
+                text = binascii.a2b_qp(text, header=True)
+            else:
+                text = base64.b64decode(text + b'=' * (-len(text) % 4))
+        except binascii.Error:
+            text = match.group(0)
+        # язык после * (RFC 2231) для декодирования не нужен
+        res.append(decode(text, charset.split(b'*')[0].decode('ascii', 'replace')))
+        pos = match.end()
+    res.append(decode(data[pos:], DEFAULT_ENCODING))
+    return ''.join(res)
+
+def parse_headers(block):
+    '''
+    Разбирает блок заголовков в словарь имя -> значение, склеивая
+    перенесенные строки (RFC 5322). Из повторяющихся полей берется первое.
+    '''
+    headers = {}
+    for match in HEADER_RE.finditer(block):
+        name = match.group(1).decode('ascii', 'replace').lower()
+        if name not in headers:
+            headers[name] = FOLD_RE.sub(b'', match.group(2))
+    return headers
+
+def header_params(value):
+    '''
+    Разбирает параметры поля вида "type; name=value; ..." (RFC 2045),
+    в том числе разбитые на части и закодированные по RFC 2231
+    (name*0*=utf-8''%D0%B0...). Возвращает словарь имя -> строка.
+    '''
+    params = {}
+    extended = {}
+    for match in PARAM_RE.finditer(value):
+        name = match.group(1).decode('ascii', 'replace').lower()
+        if match.group(2) is not None:
+            text = QUOTED_PAIR_RE.sub(rb'\1', match.group(2))
         else:
-            text = base64.b64decode(text)
-        res[match.start():match.end()] = text
-    try:
-        res = res.decode(charset)
-    except UnicodeDecodeError:
-        pass
-    return res
+            text = match.group(3)
+        ext = EXTENDED_PARAM_RE.match(name)
+        if ext:
+            encoded = ext.group(3) is not None or ext.group(2) is None
+            extended.setdefault(ext.group(1), []).append(
+                (int(ext.group(2) or 0), encoded, text)
+            )
+        else:
+            params[name] = unmime(text)
+    for name, pieces in extended.items():
+        charset = DEFAULT_ENCODING
+        text = bytearray()
+        for idx, (_, encoded, piece) in enumerate(sorted(pieces)):
+            if encoded:
+                if idx == 0 and piece.count(b"'") >= 2:
+                    charset, _, piece = piece.split(b"'", 2)
+                    charset = charset.decode('ascii', 'replace') or DEFAULT_ENCODING
+                piece = unquote_to_bytes(piece)
+            text += piece
+        params[name] = decode(text, charset)
+    return params
 
-def get_attaches(data):
+class MimePart(object):
     '''
-    Возвращает имена и размеры всех аттачей.
+    Часть MIME письма. Для аттачей по мере разбора считается размер
+    после декодирования, само содержимое не декодируется и не хранится.
     '''
-    matches = list(BOUNDARY_RE.finditer(data))
-    files = []
-    for idx in range(0, len(matches)):
-        if idx < len(matches) - 1:
-            text = data[matches[idx].start():matches[idx+1].start()+2]
+    def __init__(self, headers):
+        self.headers = headers
+        content_type = headers.get('content-type', b'text/plain')
+        self.type = content_type.split(b';', 1)[0].strip().lower()
+        self.params = header_params(content_type)
+        disposition = headers.get('content-disposition', b'')
+        self.disposition = header_params(disposition)
+        self.filename = None
+        if disposition.split(b';', 1)[0].strip().lower() == b'attachment':
+            self.filename = self.disposition.get('filename', self.params.get('name'))
+        self.encoding = headers.get(
+            'content-transfer-encoding', b'7bit'
+        ).strip().lower()
+        self.done = False
+        # тело начинается с \r\n пустой строки после заголовков, он не в счет
+        self.size = -2
+        self.chars = 0
+        self.padding = 0
+        self.ends_with_equals = False
+
+    @property
+    def boundary(self):
+        if self.type.startswith(b'multipart/') and self.params.get('boundary'):
+            return self.params['boundary'].encode('utf-8')
+        return None
+
+    def add(self, data):
+        '''
+        Учитывает очередной кусок тела. Для base64 размер считается по
+        числу символов и выравниванию, для quoted-printable - по числу
+        escape-последовательностей и мягких переносов строк.
+        '''
+        if self.encoding == b'base64':
+            self.chars += len(data) - data.count(b'\r') - data.count(b'\n') - \
+                data.count(b' ') - data.count(b'\t')
+            # выравнивание - в конце последней строки
+            tail = data[-80:].rstrip()
+            if tail:
+                self.padding = len(tail) - len(tail.rstrip(b'='))
+        elif self.encoding == b'quoted-printable':
+            soft = data.count(b'=\r\n')
+            if self.ends_with_equals and data.startswith(b'\r\n'):
+                soft += 1
+            self.size += len(data) - 2 * data.count(b'=') - soft
+            self.ends_with_equals = data.endswith(b'=')
         else:
-            text = data[matches[idx].start():]
-        filename = ATTACH_FILENAME.search(text)
-        if not filename:
-            continue
-        filename = WHITESPACE_RE.sub(rb'\1', filename.group(1))
-        filename = unmime(filename)
-        content = ATTACH_CONTENT_RE.search(text).group(1)
-        size = len(base64.b64decode(content.replace(b'\r\n', b'')))
-        files.append({'filename': filename, 'size': size})
-    return files
+            self.size += len(data)
 
-def get_main_fields(mail):
+    @property
+    def decoded_size(self):
+        if self.encoding == b'base64':
+            return self.chars * 3 // 4 - self.padding
+        return max(self.size, 0)
+
+class MimeParser(object):
     '''
-    Извлекает из заголовка поля "От", "Кому", "Тема", "Дата".
+    Разбирает MIME письмо за один проход по мере поступления данных
+    (feed), с вложенными multipart и границами из параметра boundary.
+    Запоминает заголовки письма и аттачи с размерами.
     '''
-    res = []
-    for header_re in HEADER_RES:
-        match = header_re.search(mail)
-        text = bytearray()
-        if match:
-            text += match.group(1)
-            if match.group(2):
-                text += b''.join(
-                    [x for x in HEADER_TEXT_RE.findall(match.group(2))]
-                )
-            text = unmime(text)
-        res.append(text)
-    return res
+    def __init__(self):
+        self.buffer = bytearray()
+        self.headers = None
+        self.parts = []
+        # границы открытых multipart, от внешней к внутренней
+        self.boundaries = []
+        self.part = None
+        self.in_headers = True
+
+    def feed(self, data):
+        self.buffer += data
+        while self.in_headers and self.parse_part_headers() or \
+                not self.in_headers and self.parse_body():
+            pass
+
+    def parse_part_headers(self):
+        if self.buffer.startswith(b'\r\n'):
+            end = 0
+        else:
+            end = self.buffer.find(b'\r\n\r\n')
+            if end < 0:
+                return False
+            end += 2
+        part = MimePart(parse_headers(self.buffer[:end]))
+        # \r\n пустой строки остается в буфере: граница начинается с \r\n
+        del self.buffer[:end]
+        if self.headers is None:
+            self.headers = part.headers
+        if part.boundary:
+            self.boundaries.append(part.boundary)
+            part = None
+        elif part.filename is not None:
+            self.parts.append(part)
+        else:
+            part = None
+        self.part = part
+        self.in_headers = False
+        return True
+
+    def parse_body(self):
+        '''
+        Ищет следующую границу. Тело до нее отдается текущей части,
+        без границы отдается все до последнего \r\n: с него может
+        начинаться граница, которая еще не пришла целиком.
+        '''
+        pos = 0
+        while self.boundaries:
+            start = self.buffer.find(b'\r\n--', pos)
+            if start < 0:
+                break
+            end = self.buffer.find(b'\r\n', start + 2)
+            if end < 0:
+                self.consume(start)
+                return False
+            line = self.buffer[start + 4:end].rstrip(b' \t')
+            for level in range(len(self.boundaries) - 1, -1, -1):
+                boundary = self.boundaries[level]
+                if line == boundary or line == boundary + b'--':
+                    break
+            else:
+                pos = start + 2
+                continue
+            self.consume(start)
+            self.finish_part()
+            del self.boundaries[level + 1:]
+            end -= start
+            if line == boundary:
+                del self.buffer[:end + 2]
+                self.in_headers = True
+            else:
+                # после закрывающей границы идет эпилог, его не разбираем
+                self.boundaries.pop()
+                del self.buffer[:end]
+            return True
+        self.consume(self.buffer.rfind(b'\r\n'))
+        return False
+
+    def consume(self, size):
+        if size <= 0:
+            return
+        if self.part:
+            self.part.add(memoryview(self.buffer)[:size].tobytes())
+        del self.buffer[:size]
+
+    def finish_part(self):
+        if self.part:
+            self.part.done = True
+            self.part = None
+
+    def close(self, complete=True):
+        '''
+        Заканчивает разбор. Если письмо получено целиком, остаток буфера
+        относится к последней части.
+        '''
+        if complete:
+            # последняя строка могла прийти без \r\n
+            self.feed(b'\r\n')
+            if self.in_headers and self.buffer.strip():
+                self.feed(b'\r\n')
+            self.consume(len(self.buffer) - 2)
+            self.finish_part()
+        if self.headers is None:
+            self.headers = {}
+
+    def attaches(self):
+        '''
+        Имена и размеры аттачей. Для оборванного аттача размер берется из
+        параметра size в Content-Disposition (RFC 2183), а без него - None.
+        '''
+        res = []
+        for part in self.parts:
+            size = part.decoded_size if part.done else None
+            if size is None and part.disposition.get('size', '').isdigit():
+                size = int(part.disposition['size'])
+            res.append({'filename': part.filename, 'size': size})
+        return res
+
+def get_attaches(data, complete=True):
+    '''
+    Возвращает имена и размеры всех аттачей.
+    '''
+    parser = MimeParser()
+    parser.feed(data)
+    parser.close(complete)
+    return parser.attaches()
+
+def get_main_fields(headers):
+    '''
+    Извлекает из заголовка поля "Дата", "Кому", "От", "Тема".
+    '''
+    return [unmime(headers.get(name, b'')) for name in MAIN_FIELDS]
+
+def unstuff(lines):
+    '''
+    Убирает точку, добавленную сервером в начало строк, начинающихся
+    с точки. lines должны начинаться с начала строки.
+    '''
+    if lines.startswith(b'.'):
+        del lines[:1]
+    return lines.replace(b'\r\n..', b'\r\n.')
+
+class SyncState(object):
+    '''
+    Уникальные идентификаторы (UIDL) уже показанных писем, по списку на
+    ящик, в JSON файле. Удаленные с сервера письма из файла забываются,
+    так что он не растет.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.boxes = {}
+        try:
+            with open(filename) as f:
+                self.boxes = {box: set(uids) for box, uids in json.load(f).items()}
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, AttributeError) as e:
+            raise POP3Exception('Не удалось прочитать {}: {}'.format(filename, e))
+
+    def seen(self, mailbox):
+        return self.boxes.setdefault(mailbox, set())
+
+    def forget(self, mailbox, uids):
+        '''
+        Оставляет для ящика только письма, которые сейчас есть на сервере.
+        '''
+        self.boxes[mailbox] = self.seen(mailbox) & set(uids)
+
+    def save(self):
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({box: sorted(uids) for box, uids in self.boxes.items()}, f)
+        os.replace(tmp, self.filename)
+
+def tls_context():
+    '''
+    Контекст TLS, как у прежнего ssl.wrap_socket: сертификат сервера не
+    проверяется. Сессии можно возобновлять только в том же контексте.
+    '''
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
 
 class POP3(object):
     '''
     Обертка над протоколом POP3.
     '''
-    def __init__(self):
+    def __init__(self, context=None):
         self.sock = socket.socket()
         self.sock.settimeout(6)
+        self.context = context
         self.connected = False
+        # принятые, но еще не разобранные данные
+        self.buffer = bytearray()
+        self.chunk = bytearray(RECV_SIZE)
+        self.chunk_view = memoryview(self.chunk)
+        self.capabilities = None
 
-    def connect(self, server, port):
+    def connect(self, server, port, session=None):
+        '''
+        Подключается к серверу и возвращает его приветствие. На порту
+        SSL_PORT соединение шифруется; переданная session (TLS сессия
+        прошлого подключения к этому серверу) возобновляется без полного
+        рукопожатия.
+        '''
         if port == SSL_PORT:
-            self.sock = ssl.wrap_socket(self.sock)
+            if self.context is None:
+                self.context = tls_context()
+            self.sock = self.context.wrap_socket(
+                self.sock, server_hostname=server, session=session
+            )
         try:
             self.sock.connect((server, port))
         except socket.timeout:
             raise POP3Exception('Не удалось подключиться к серверу: {}'.format(server))
 
-        print(self.sock.recv(1024).decode('ascii'))
+        greeting = self.receive_one_line().decode('ascii', 'replace')
         self.connected = True
+        return greeting
 
-    def send_and_receive_one_line(self, msg):
+    @property
+    def session(self):
         '''
-        Отправляет указанную команду, получает многострочный ответ.
-        Сигнал конца сообщения - \r\n
+        TLS сессия соединения, None для нешифрованного.
+        '''
+        return getattr(self.sock, 'session', None)
+
+    def fill(self):
+        '''
+        Дочитывает данные из сокета в буфер.
+        '''
+        try:
+            size = self.sock.recv_into(self.chunk)
+        except socket.timeout:
+            raise POP3Exception('Что-то пошло не так.')
+        if not size:
+            raise POP3Exception('Сервер закрыл соединение.')
+        self.buffer += self.chunk_view[:size]
+
+    def take(self, size):
+        resp = self.buffer[:size]
+        del self.buffer[:size]
+        return resp
+
+    def receive_one_line(self):
+        '''
+        Получает однострочный ответ. Сигнал конца сообщения - \r\n
+        '''
+        while True:
+            end = self.buffer.find(b'\r\n')
+            if end >= 0:
+                return self.take(end + 2)
+            self.fill()
+
+    def receive_multiline(self):
+        '''
+        Получает многострочный ответ целиком: строку статуса, тело без
+        экранирования точек и завершающую строку из одной точки.
+        Ответ -ERR всегда однострочный.
         '''
-        self.sock.sendall(msg)
         resp = bytearray()
+        status = self.stream_multiline(resp.extend)
+        if not status.startswith(b'+OK'):
+            return status
+        return status + resp + b'.\r\n'
+
+    def stream_multiline(self, sink):
+        '''
+        Получает многострочный ответ, не собирая его в памяти: тело по
+        мере получения отдается в sink целыми строками, без экранирования
+        точек (RFC 1939) и без завершающей строки из одной точки.
+        Возвращает строку статуса. Данные следующих ответов остаются
+        в буфере.
+        '''
+        status = self.receive_one_line()
+        if not status.startswith(b'+OK'):
+            return status
+        # буфер всегда начинается с начала строки тела
         while True:
-            try:
-                resp += self.sock.recv(1024)
-            except socket.timeout:
-                raise POP3Exception('Что-то пошло не так.')
-            if resp[-2:] == b'\r\n':
-                break
+            if self.buffer.startswith(b'.\r\n'):
+                del self.buffer[:3]
+                return status
+            end = self.buffer.find(b'\r\n.\r\n')
+            if end >= 0:
+                sink(unstuff(self.take(end + 2)))
+                del self.buffer[:3]
+                return status
+            end = self.buffer.rfind(b'\r\n')
+            if end >= 0:
+                sink(unstuff(self.take(end + 2)))
+            self.fill()
 
-        return resp
+    def send_and_receive_one_line(self, msg):
+        '''
+        Отправляет указанную команду, получает однострочный ответ.
+        '''
+        self.sock.sendall(msg)
+        return self.receive_one_line()
 
     def send_and_receive_multiline(self, msg):
         '''
         Отправляет указанную команду, получает многострочный ответ.
-        Сигнал конца сообщения - .\r\n
         '''
         self.sock.sendall(msg)
-        resp = bytearray()
-        while True:
-            try:
-                resp += self.sock.recv(1024)
-            except socket.timeout:
-                raise POP3Exception()
-            if resp[-3:] == b'.\r\n':
-                break
+        return self.receive_multiline()
 
-        return resp
+    def pipeline(self, commands, sink):
+        '''
+        Отправляет команды с многострочными ответами. Если сервер
+        поддерживает PIPELINING (RFC 2449), следующие команды уходят, не
+        дожидаясь ответов на предыдущие, но без ответа их не больше
+        PIPELINE_DEPTH. Тело каждого ответа по мере получения уходит
+        в sink, как в stream_multiline, а отдаются строки статуса в
+        порядке команд. Следующий ответ читается только при запросе
+        следующего статуса, так что между ними sink можно подменить.
+        '''
+        if self.capabilities is None:
+            self.capa()
+        depth = PIPELINE_DEPTH if 'PIPELINING' in self.capabilities else 1
+        commands = iter(commands)
+        batch = list(islice(commands, depth))
+        self.sock.sendall(b''.join(batch))
+        in_flight = len(batch)
+        while in_flight:
+            status = self.stream_multiline(sink)
+            in_flight -= 1
+            command = next(commands, None)
+            if command:
+                self.sock.sendall(command)
+                in_flight += 1
+            yield status
+
+    def capa(self):
+        '''
+        Запрашивает возможности сервера командой CAPA. Если сервер ее не
+        знает, считаем, что возможностей нет.
+        '''
+        resp = self.send_and_receive_multiline(b'CAPA\r\n')
+        self.capabilities = set()
+        if resp.startswith(b'+OK'):
+            for line in resp.split(b'\r\n')[1:-2]:
+                if line:
+                    self.capabilities.add(line.split()[0].decode('ascii').upper())
+        return self.capabilities
 
     def __enter__(self):
         return self
@@ -177,30 +564,104 @@ class POP3(object):
             self.sock.sendall(b'QUIT\r\n')
         self.sock.close()
 
-    def get_messages(self):
+    def retr(self, num, sink):
         '''
-        Получает последние сообщения при помощи LIST.
-        Затем для каждого номера, возвращенного LIST'ом, получает базовую
-        информацию о письме с указанным номером.
+        Скачивает письмо, отдавая его по частям в sink, например в
+        метод write открытого файла.
+        '''
+        self.sock.sendall('RETR {}\r\n'.format(num).encode('ascii'))
+        if not self.stream_multiline(sink).startswith(b'+OK'):
+            raise POP3Exception('Не удалось получить письмо {}.'.format(num))
+
+    def list_sizes(self):
+        '''
+        Номера и размеры писем в ящике по LIST.
         '''
         list_ = self.send_and_receive_multiline(b'LIST\r\n')
+        res = {}
         for line in list_.split(b'\r\n')[1:-2]:
-            num = int(line.split(b' ')[0])
-            mail = self.send_and_receive_multiline(
-                'RETR {}\r\n'.format(num).encode('ascii')
+            num, size = line.split(b' ')[:2]
+            res[int(num)] = int(size)
+        return res
+
+    def uidl(self):
+        '''
+        Уникальные идентификаторы писем: номер -> UID. Если сервер не
+        поддерживает UIDL, возвращает None.
+        '''
+        resp = self.send_and_receive_multiline(b'UIDL\r\n')
+        if not resp.startswith(b'+OK'):
+            return None
+        res = {}
+        for line in resp.split(b'\r\n')[1:-2]:
+            num, uid = line.split(b' ')[:2]
+            res[int(num)] = uid.decode('ascii')
+        return res
+
+    def get_messages(self, nums=None, top=None, save_to=None):
+        '''
+        Получает последние сообщения при помощи LIST.
+        Затем для каждого номера, возвращенного LIST'ом (или из nums),
+        получает базовую информацию о письме с указанным номером. Если
+        задан top, вместо RETR письмо запрашивается командой TOP: заголовки
+        и первые top строк тела, так что тяжелые аттачи не скачиваются.
+        Если задан каталог save_to, письма, скачанные RETR, по пути
+        в парсер пишутся туда же как <номер>.eml.
+        Команды отправляются конвейером, если сервер это позволяет.
+        '''
+        sizes = self.list_sizes()
+        if nums is None:
+            nums = list(sizes)
+        if top is None:
+            commands = ('RETR {}\r\n'.format(num) for num in nums)
+        else:
+            commands = ('TOP {} {}\r\n'.format(num, top) for num in nums)
+        if top is not None:
+            save_to = None
+        # письмо разбирается по мере получения, целиком в памяти не собирается
+        parser = MimeParser()
+        out = None
+
+        def tee(data):
+            parser.feed(data)
+            if out:
+                out.write(data)
+
+        statuses = self.pipeline((command.encode('ascii') for command in commands), tee)
+        for num in nums:
+            if save_to:
+                out = open(os.path.join(save_to, '{}.eml'.format(num)), 'wb')
+            try:
+                status = next(statuses)
+            finally:
+                if out:
+                    out.close()
+            if not status.startswith(b'+OK'):
+                raise POP3Exception('Не удалось получить письмо {}.'.format(num))
+            parser.close(complete=top is None)
+            date, to, from_, subj = get_main_fields(parser.headers)
+            attaches = parser.attaches()
+            # следующий ответ пойдет уже в новый парсер
+            parser = MimeParser()
+            yield MailInfo(
+                num, from_, to, subj, date, attaches, sizes.get(num), top is not None
             )
-            date, to, from_, subj = get_main_fields(mail)
-            attaches = get_attaches(mail)
-            yield MailInfo(num, from_, to, subj, date, attaches)
 
 def print_mailinfo(mail):
     print('Msg #{}:'.format(mail.num))
+    if mail.size is not None:
+        print('    Size: {} bytes'.format(mail.size))
     print('    Date: {}'.format(mail.date))
     print('    To: {}'.format(mail.to))
     print('    From: {}'.format(mail.from_))
     print('    Subject: {}'.format(mail.subject))
-    print('    Attachments: {}'.format(len(mail.attaches)))
+    print('    Attachments: {}{}'.format(
+        len(mail.attaches), ' or more' if mail.partial else ''
+    ))
     for attach in mail.attaches:
+        if attach['size'] is None:
+            print('        {}, size unknown'.format(attach['filename']))
+            continue
         print('        {}, {} bytes'.format(
             attach['filename'], attach['size']
         ))
@@ -215,14 +676,51 @@ def main():
     parser.add_argument('port', type=int, help='Port of POP3 server')
     parser.add_argument('username', type=str, help='POP3 username')
     parser.add_argument('password', type=str, help='POP3 password')
+    parser.add_argument(
+        '-t', metavar='lines', type=int,
+        help='fetch only headers and this many body lines with TOP instead '
+             'of whole messages; attachments past them are listed without size'
+    )
+    parser.add_argument(
+        '-s', metavar='file', type=str,
+        help='UIDL state file: show only messages not shown in previous runs'
+    )
+    parser.add_argument(
+        '-o', metavar='dir', type=str,
+        help='also save shown messages to this directory as <number>.eml'
+    )
     args = parser.parse_args()
 
     with POP3() as pop3:
         try:
-            pop3.connect(args.server, args.port)
+            print(pop3.connect(args.server, args.port))
             pop3.auth(args.username, args.password)
-            for mail in pop3.get_messages():
-                print_mailinfo(mail)
+            mailbox = '{}@{}:{}'.format(args.username, args.server, args.port)
+            state = uids = nums = None
+            if args.s:
+                state = SyncState(args.s)
+                uids = pop3.uidl()
+                if uids is None:
+                    print('Server does not support UIDL, showing all messages.')
+                else:
+                    seen = state.seen(mailbox)
+                    nums = [num for num, uid in uids.items() if uid not in seen]
+            try:
+                shown = []
+                for mail in pop3.get_messages(nums, args.t, args.o):
+                    print_mailinfo(mail)
+                    shown.append(mail.num)
+                    if uids is not None:
+                        seen.add(uids[mail.num])
+                if args.o and args.t is not None:
+                    # TOP скачал не все письмо, целиком его отдает только RETR
+                    for num in shown:
+                        with open(os.path.join(args.o, '{}.eml'.format(num)), 'wb') as f:
+                            pop3.retr(num, f.write)
+            finally:
+                if uids is not None:
+                    state.forget(mailbox, uids.values())
+                    state.save()
         except POP3Exception as e:
             print('ERROR: {}'.format(e))
 
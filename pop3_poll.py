@@ -0,0 +1,183 @@
+'''
+Опрашивает много POP3 ящиков параллельно: не больше заданного числа
+соединений всего и на один сервер. TLS сессии запоминаются по серверам
+и возобновляются при следующих подключениях. Результат по каждому ящику
+печатается JSON строкой по мере готовности.
+'''
+import json
+import threading
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pop3
+
+DEFAULT_WORKERS = 32
+DEFAULT_PER_SERVER = 4
+
+class Account(object):
+    def __init__(self, server, port, username, password):
+        self.server = server
+        self.port = port
+        self.username = username
+        self.password = password
+
+    @property
+    def mailbox(self):
+        return '{}@{}:{}'.format(self.username, self.server, self.port)
+
+def read_accounts(filename):
+    '''
+    Читает ящики из файла, по одному в строке: "сервер порт логин пароль".
+    Пароль - остаток строки, в нем могут быть пробелы. Пустые строки и
+    строки, начинающиеся с #, пропускаются.
+    '''
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                server, port, username, password = line.split(None, 3)
+                yield Account(server, int(port), username, password)
+            except ValueError:
+                raise pop3.POP3Exception('Bad account line: {}'.format(line))
+
+def interleave(accounts):
+    '''
+    Чередует ящики разных серверов, чтобы потоки пула не простаивали
+    в очереди к одному серверу, пока другие свободны.
+    '''
+    by_server = {}
+    for account in accounts:
+        by_server.setdefault(account.server, []).append(account)
+    queues = list(by_server.values())
+    res = []
+    while queues:
+        res.extend(queue.pop(0) for queue in queues)
+        queues = [queue for queue in queues if queue]
+    return res
+
+class Poller(object):
+    def __init__(self, accounts, per_server, top=None, state=None):
+        self.accounts = interleave(accounts)
+        self.top = top
+        self.state = state
+        self.context = pop3.tls_context()
+        self.limits = {
+            account.server: threading.BoundedSemaphore(per_server)
+            for account in self.accounts
+        }
+        # последняя TLS сессия по каждому серверу
+        self.sessions = {}
+
+    def poll(self, account):
+        '''
+        Получает новые письма одного ящика. Вызывается в потоках пула.
+        '''
+        res = {'mailbox': account.mailbox}
+        start = time.monotonic()
+        with self.limits[account.server]:
+            try:
+                with pop3.POP3(self.context) as client:
+                    client.connect(
+                        account.server, account.port,
+                        self.sessions.get((account.server, account.port))
+                    )
+                    if client.session is not None:
+                        res['tls_resumed'] = client.sock.session_reused
+                    client.auth(account.username, account.password)
+                    res['messages'] = self.fetch(client, account)
+                    if client.session is not None:
+                        self.sessions[(account.server, account.port)] = client.session
+            except Exception as e:
+                # что бы ни случилось с одним ящиком (в том числе не-ASCII
+                # логин или битый ответ LIST/UIDL), остальные опрашиваются
+                res['error'] = str(e) or type(e).__name__
+        res['elapsed'] = round(time.monotonic() - start, 3)
+        return res
+
+    def fetch(self, client, account):
+        '''
+        Получает новые письма ящика. В состояние они попадают, только
+        когда получены все: если ящик упал на середине, письма из его
+        ответа не потеряются и придут в следующий раз.
+        '''
+        uids = nums = None
+        if self.state is not None:
+            uids = client.uidl()
+            if uids is not None:
+                seen = self.state.seen(account.mailbox)
+                nums = [num for num, uid in uids.items() if uid not in seen]
+        messages = []
+        for mail in client.get_messages(nums, self.top):
+            info = mail.as_dict()
+            if uids is not None:
+                info['uid'] = uids[mail.num]
+            messages.append(info)
+        if uids is not None:
+            seen.update(info['uid'] for info in messages)
+            self.state.forget(account.mailbox, uids.values())
+        return messages
+
+    def run(self, pool):
+        futures = [pool.submit(self.poll, account) for account in self.accounts]
+        for future in as_completed(futures):
+            yield future.result()
+
+def main():
+    parser = ArgumentParser(
+        description='Polls many POP3 mailboxes at once and prints '
+                    'new messages as JSON lines, one line per mailbox.',
+        epilog='Usage example: pop3_poll.py accounts.txt -t 0 -s state.json -i 60'
+    )
+    parser.add_argument(
+        'accounts', type=str,
+        help='file with mailboxes, one "server port username password" per line'
+    )
+    parser.add_argument(
+        '-w', metavar='workers', type=int, default=DEFAULT_WORKERS,
+        help='connections at once. Default: {}'.format(DEFAULT_WORKERS)
+    )
+    parser.add_argument(
+        '-p', metavar='per server', type=int, default=DEFAULT_PER_SERVER,
+        help='connections at once to one server. Default: {}'.format(DEFAULT_PER_SERVER)
+    )
+    parser.add_argument(
+        '-t', metavar='lines', type=int,
+        help='fetch only headers and this many body lines with TOP'
+    )
+    parser.add_argument(
+        '-s', metavar='file', type=str,
+        help='UIDL state file: report only messages not reported before'
+    )
+    parser.add_argument(
+        '-i', metavar='interval', type=float, default=0,
+        help='poll again every interval seconds, 0 - poll once. Default: 0'
+    )
+    args = parser.parse_args()
+
+    try:
+        accounts = list(read_accounts(args.accounts))
+        state = pop3.SyncState(args.s) if args.s else None
+    except (pop3.POP3Exception, OSError) as e:
+        print('ERROR: {}'.format(e))
+        return
+
+    poller = Poller(accounts, args.p, args.t, state)
+    try:
+        with ThreadPoolExecutor(args.w) as pool:
+            while True:
+                start = time.monotonic()
+                for res in poller.run(pool):
+                    print(json.dumps(res, ensure_ascii=False), flush=True)
+                if state is not None:
+                    state.save()
+                if not args.i:
+                    break
+                time.sleep(max(0, start + args.i - time.monotonic()))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
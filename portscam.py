@@ -1,103 +1,796 @@
 import socket
+import os
+import zlib
+import base64
+import select
+import selectors
+import struct
+import random
+import re
+import errno
+import sys
+import time
+import threading
+import queue
+import json
+import csv
 import argparse
 from concurrent.futures import ThreadPoolExecutor
 
-'''
-еще не доделано
+DEFAULT_WORKERS = 512
+DEFAULT_TIMEOUT = 3
+DEFAULT_RETRIES = 1
+DEFAULT_RATE = 1000
+MIN_RATE = 10
+# ошибки connect, означающие, что до порта не пускает фильтр (ICMP unreachable)
+FILTERED_ERRNOS = (errno.EHOSTUNREACH, errno.ENETUNREACH, errno.EACCES, errno.EPERM)
+OUTPUT_FORMATS = ('text', 'json', 'csv')
+CSV_FIELDS = ('host', 'port', 'state', 'rtt', 'service')
+# как часто перерисовывать строку прогресса, в секундах
+PROGRESS_INTERVAL = 0.5
+# как часто сохранять состояние сканирования, в секундах
+CHECKPOINT_INTERVAL = 10
+CHECKPOINT_VERSION = 1
+
+DNS_TRANS_ID = struct.pack('!H', random.randint(0, 65000))
+# стандартный рекурсивный запрос A-записи google.com
+DNS_QUERY = DNS_TRANS_ID + \
+    b'\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x06google\x03com\x00\x00\x01\x00\x01'
+# у ответа DNS совпадает идентификатор и выставлен бит QR
+DNS_ANSWER_RE = re.compile(re.escape(DNS_TRANS_ID) + rb'[\x80-\xff]')
+NTP_QUERY = struct.pack(
+    '!BBBbIIIIIIIIIII',
+    (2 << 3) | 3, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0
+)
+# ответ NTP - 48 байт, режим 4 (server) в младших битах первого байта
+NTP_ANSWER_RE = re.compile(
+    b'[' + re.escape(bytes(x for x in range(256) if x % 8 == 4)) + b'].{47}',
+    flags=re.DOTALL
+)
+# протокол: (что отправить, как выглядит ответ). SMTP и POP3 сервера
+# здороваются первыми, им ничего отправлять не нужно
 TCP_PROTOCOL_CHECKS = {
     'HTTP': (
-        b'GET / HTTP/1.1\r\nHost: google.com\r\n\r\n',
-        b'HTTP/1.1'
+        b'HEAD / HTTP/1.0\r\n\r\n',
+        re.compile(rb'HTTP/\d\.\d \d{3}')
     ),
     'SMTP': (
-        b'EHLO 452423',
-        b'stub'
+        None,
+        re.compile(rb'220[ -][^\r\n]*SMTP', flags=re.IGNORECASE)
     ),
     'POP3': (
-        b'USER python',
-        b'PASS'
-    )
-}
-DNS_TRANS_ID = struct.pack('!H', random.randint(0, 65000))
-UDP_PROTOCOL_CHECKS = {
-    'NTP': (
-        struct.pack(
-            "!BBBbIIIIIIIIIII",
-            (2 << 3) | 3, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0
-        ),
-        b'stub'
+        None,
+        re.compile(rb'\+OK')
     ),
     'DNS': (
-        DNS_TRANS_ID+b'\x00\x00\x01\x00\x00\x00\x00\x00\x00\x06google\x03com\x00\x00\x01\x00\x01',
-        DNS_TRANS_ID
+        # по TCP DNS сообщение предваряется длиной
+        struct.pack('!H', len(DNS_QUERY)) + DNS_QUERY,
+        re.compile(rb'.{2}' + DNS_ANSWER_RE.pattern, flags=re.DOTALL)
     )
 }
+UDP_PROTOCOL_CHECKS = {
+    'NTP': (NTP_QUERY, NTP_ANSWER_RE),
+    'DNS': (DNS_QUERY, DNS_ANSWER_RE)
+}
+# этот запрос шлется по соединению, оставшемуся от проверки порта,
+# если сервер не поздоровался за BANNER_WAIT секунд
+REUSED_CONNECTION_CHECK = 'HTTP'
+BANNER_WAIT = 0.5
+PROBE_TIMEOUT = 3
+DEFAULT_PROBE_WORKERS = 64
+# на остальные порты при UDP сканировании шлется пустая датаграмма
+UDP_PORT_PAYLOADS = {
+    53: UDP_PROTOCOL_CHECKS['DNS'][0],
+    123: UDP_PROTOCOL_CHECKS['NTP'][0]
+}
+DEFAULT_UDP_BATCH = 256
+ICMP_DEST_UNREACH = 3
+ICMP_PORT_UNREACH = 3
+UDP_PROTO = 17
 
-def check_port_udp(port, addr):
-    pass
+class PortInfo(object):
+    def __init__(self, addr, port, state, rtt=None, sock=None):
+        self.addr = addr
+        self.port = port
+        self.state = state
+        self.rtt = rtt
+        self.service = None
+        # соединение, оставленное открытым для определения протокола
+        self.sock = sock
+
+    def as_dict(self):
+        '''
+        Представление для машиночитаемого вывода. RTT в миллисекундах.
+        '''
+        return {
+            'host': self.addr,
+            'port': self.port,
+            'state': self.state,
+            'rtt': round(self.rtt * 1000, 3) if self.rtt is not None else None,
+            'service': self.service
+        }
+
+class Progress(object):
+    '''
+    Живой счетчик просканированных портов и скорости сканирования.
+    Пишет в stderr, чтобы не мешать выводу результатов в stdout.
+    '''
+    def __init__(self, total, stream=sys.stderr):
+        self.total = total
+        self.stream = stream
+        self.done = 0
+        self.opened = 0
+        self.start = time.monotonic()
+        self.last_draw = 0
+        self.last_len = 0
+
+    def update(self, info):
+        self.done += 1
+        if info.state == 'open':
+            self.opened += 1
+        now = time.monotonic()
+        if now - self.last_draw >= PROGRESS_INTERVAL or self.done == self.total:
+            self.draw(now)
+
+    def draw(self, now):
+        self.last_draw = now
+        elapsed = now - self.start
+        rate = self.done / elapsed if elapsed else 0
+        line = '{}/{} ports ({:.1f}%), {:.0f} ports/s, {} open'.format(
+            self.done, self.total, 100 * self.done / self.total, rate, self.opened
+        )
+        self.stream.write('\r' + line.ljust(self.last_len))
+        self.stream.flush()
+        self.last_len = len(line)
+
+    def clear(self):
+        '''
+        Стирает строку прогресса, чтобы результат не печатался поверх нее.
+        '''
+        if self.last_len:
+            self.stream.write('\r' + ' ' * self.last_len + '\r')
+            self.stream.flush()
+            self.last_draw = 0
 
-def check_protocols(address, port):
-    res = []
-    for proto, signs in TCP_PROTOCOL_CHECKS.items():
-        with socket.socket() as sock:
-            sock.settimeout(3)
-            try:
-                sock.connect((address, port))
-            except socket.timeout:
-                return []
-'''
+    def finish(self):
+        if self.last_len:
+            self.stream.write('\n')
+            self.stream.flush()
 
-def check_port_tcp(port, addr):
+class RateLimiter(object):
+    '''
+    Ограничивает число попыток соединения в секунду (token bucket) и
+    подстраивает скорость на манер TCP congestion control: если доля
+    таймаутов в окне проверок резко выросла относительно обычной для этого
+    хоста, скорость уменьшается вдвое, иначе понемногу растет обратно.
+    Потокобезопасен, один экземпляр на все сканирование.
+    '''
+    WINDOW = 100
+    SPIKE = 0.2
+
+    def __init__(self, rate):
+        self.max_rate = rate
+        self.rate = rate
+        self.tokens = 1.0
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+        self.probes = 0
+        self.timeouts = 0
+        # обычная доля таймаутов; у хоста за файрволом она может быть около 1
+        self.baseline = None
+
+    def acquire(self):
+        '''
+        Забирает один токен, при необходимости засыпает до его появления.
+        '''
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(1.0, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+    def report(self, timed_out):
+        '''
+        Учитывает результат очередной попытки и раз в окно меняет скорость.
+        '''
+        with self.lock:
+            self.probes += 1
+            self.timeouts += timed_out
+            if self.probes < self.WINDOW:
+                return
+            ratio = self.timeouts / self.probes
+            self.probes = self.timeouts = 0
+            if self.baseline is None:
+                self.baseline = ratio
+                return
+            if ratio > self.baseline + self.SPIKE:
+                self.rate = max(MIN_RATE, self.rate / 2)
+            else:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+            self.baseline = 0.8 * self.baseline + 0.2 * ratio
+
+def check_port_tcp(port, addr, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES,
+                   limiter=None, keep_open=False):
     '''
     Пытается подсоединиться к указанному хосту по указанному
     порту и сообщает результат.
-    Законнектились - значит порт открыт, иначе считаем его закрытым.
+    Законнектились - порт открыт, получили RST - закрыт. Если ответа нет
+    или пришел ICMP unreachable, порт фильтруется; в случае таймаута
+    пробуем еще retries раз, пакет мог просто потеряться. Прочие ошибки
+    (кончились дескрипторы, нет свободного локального порта) дают
+    состояние error только этому порту, скан продолжается.
+    С keep_open соединение с открытым портом не закрывается, а отдается
+    в PortInfo для определения протокола.
     '''
-    sock = socket.socket()
-    sock.settimeout(3)
-    try:
-        with sock:
+    for _ in range(retries + 1):
+        if limiter:
+            limiter.acquire()
+        try:
+            sock = socket.socket()
+        except OSError:
+            return PortInfo(addr, port, 'error')
+        sock.settimeout(timeout)
+        start = time.monotonic()
+        try:
             sock.connect((addr, port))
-    except socket.timeout:
-        return False, port
+        except socket.timeout:
+            sock.close()
+            if limiter:
+                limiter.report(True)
+            continue
+        except (ConnectionRefusedError, ConnectionResetError):
+            sock.close()
+            state = 'closed'
+        except OSError as e:
+            sock.close()
+            state = 'filtered' if e.errno in FILTERED_ERRNOS else 'error'
+        else:
+            state = 'open'
+        rtt = time.monotonic() - start
+        if limiter:
+            limiter.report(False)
+        if state == 'open' and keep_open:
+            return PortInfo(addr, port, state, rtt, sock)
+        sock.close()
+        return PortInfo(addr, port, state, rtt)
 
-    return True, port
+    return PortInfo(addr, port, 'filtered')
 
-def scan_ports(addr, start, end):
+class Probe(object):
+    '''
+    Одна проба протокола: сокет, запрос, который в него нужно отправить
+    (не раньше send_at), и проверки, которым сверяется ответ.
+    '''
+    def __init__(self, sock, payload, checks, send_at=0):
+        self.sock = sock
+        self.payload = payload
+        self.checks = checks
+        self.send_at = send_at
+        self.data = bytearray()
+
+def match_protocol(data, checks):
+    for proto, (_, sign) in checks.items():
+        if sign.match(data):
+            return proto
+    return None
+
+def check_protocols(addr, port, sock=None, timeout=PROBE_TIMEOUT):
+    '''
+    Определяет протокол на открытом TCP порту. Все пробы идут одновременно
+    в одном потоке: по соединению из проверки порта ждем приветствие
+    (SMTP, POP3), а если его нет - шлем HTTP запрос; остальные TCP запросы
+    идут по новым соединениям, DNS и NTP - по UDP на тот же номер порта.
+    Возвращает название первого опознанного протокола или None.
+    '''
+    now = time.monotonic()
+    deadline = now + timeout
+    probes = []
+    if sock is None:
+        try:
+            sock = socket.create_connection((addr, port), timeout)
+        except OSError:
+            return None
+    probes.append(Probe(
+        sock, TCP_PROTOCOL_CHECKS[REUSED_CONNECTION_CHECK][0],
+        TCP_PROTOCOL_CHECKS, now + BANNER_WAIT
+    ))
+    selector = selectors.DefaultSelector()
+    try:
+        for proto, (payload, _) in TCP_PROTOCOL_CHECKS.items():
+            if payload is None or proto == REUSED_CONNECTION_CHECK:
+                continue
+            probes.append(Probe(socket.socket(), payload, TCP_PROTOCOL_CHECKS))
+        for payload, _ in UDP_PROTOCOL_CHECKS.values():
+            probes.append(Probe(
+                socket.socket(socket.AF_INET, socket.SOCK_DGRAM), payload, UDP_PROTOCOL_CHECKS
+            ))
+
+        for probe in probes:
+            probe.sock.setblocking(False)
+            if probe is probes[0]:
+                selector.register(probe.sock, selectors.EVENT_READ, probe)
+                continue
+            # для UDP connect ничего не отправляет, зато отсеивает чужие ответы
+            probe.sock.connect_ex((addr, port))
+            selector.register(probe.sock, selectors.EVENT_WRITE, probe)
+
+        while selector.get_map():
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            reused = probes[0]
+            if reused.payload and reused.sock not in selector.get_map():
+                # соединение уже закрыто или сломалось, слать некуда
+                reused.payload = None
+            if reused.payload and reused.send_at <= now:
+                try:
+                    reused.sock.send(reused.payload)
+                except OSError:
+                    selector.unregister(reused.sock)
+                reused.payload = None
+            wait = deadline - now
+            if reused.payload:
+                wait = min(wait, reused.send_at - now)
+            for key, events in selector.select(wait):
+                probe = key.data
+                try:
+                    if events & selectors.EVENT_WRITE:
+                        err = probe.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                        if err:
+                            raise OSError(err, 'connect failed')
+                        probe.sock.send(probe.payload)
+                        selector.modify(probe.sock, selectors.EVENT_READ, probe)
+                        continue
+                    data = probe.sock.recv(4096)
+                except OSError:
+                    selector.unregister(probe.sock)
+                    continue
+                if not data:
+                    selector.unregister(probe.sock)
+                    continue
+                if probe is reused:
+                    # сервер заговорил первым, HTTP слать уже незачем
+                    reused.payload = None
+                probe.data += data
+                proto = match_protocol(probe.data, probe.checks)
+                if proto:
+                    return proto
+        return None
+    finally:
+        selector.close()
+        for probe in probes:
+            probe.sock.close()
+
+def identify(info):
+    '''
+    Второй этап конвейера: определяет протокол на открытом порту,
+    используя соединение, оставшееся от проверки.
+    '''
+    sock, info.sock = info.sock, None
+    try:
+        info.service = check_protocols(info.addr, info.port, sock)
+    except Exception:
+        # ошибка одной пробы не должна ронять весь скан
+        info.service = None
+    return info
+
+def scan_ports(addr, start, end, workers=DEFAULT_WORKERS, timeout=DEFAULT_TIMEOUT,
+               retries=DEFAULT_RETRIES, rate=DEFAULT_RATE,
+               proto=False, proto_workers=DEFAULT_PROBE_WORKERS, done=()):
     '''
     Многопоточно сканирует хост на предмет открытых TCP портов.
+    Результаты отдаются в порядке завершения проверок, а не в порядке
+    номеров портов, чтобы открытый порт не ждал таймаутов на соседних.
+    rate - максимум попыток соединения в секунду, 0 - без ограничения.
+    С proto открытые порты передаются во второй пул, не больше
+    proto_workers потоков, который определяет на них протокол.
+    Порты из done уже проверены и пропускаются.
     '''
     addr = socket.gethostbyname(addr)
-    executor = ThreadPoolExecutor(max_workers=65536)
-    with executor:
-        results = executor.map(check_port_tcp, range(start, end + 1), [addr] * (end + 1 - start))
-        for res, port in results:
-            if res:
-                yield port
+    limiter = RateLimiter(rate) if rate else None
+    # обе стадии складывают готовые futures сюда, в порядке завершения
+    completed = queue.Queue()
+    futures = []
+    executor = ThreadPoolExecutor(max_workers=workers)
+    proto_executor = ThreadPoolExecutor(max_workers=proto_workers)
+    with executor, proto_executor:
+        try:
+            for port in range(start, end + 1):
+                if port in done:
+                    continue
+                future = executor.submit(
+                    check_port_tcp, port, addr, timeout, retries, limiter, proto
+                )
+                future.add_done_callback(completed.put)
+                futures.append(future)
+            outstanding = len(futures)
+            while outstanding:
+                info = completed.get().result()
+                outstanding -= 1
+                if info.sock is not None:
+                    proto_executor.submit(identify, info).add_done_callback(completed.put)
+                    outstanding += 1
+                    continue
+                yield info
+        finally:
+            # если сканирование прервали, не ждем проверки оставшихся портов
+            for future in futures:
+                future.cancel()
+
+def parse_icmp_unreach(packet):
+    '''
+    Разбирает пришедший на raw сокет IP пакет. Если это ICMP Destination
+    Unreachable на наш UDP пакет, возвращает код ICMP, адрес назначения
+    и порты (источник, назначение) из процитированного заголовка.
+    '''
+    ihl = (packet[0] & 0xf) * 4
+    if len(packet) < ihl + 8 + 20 or packet[ihl] != ICMP_DEST_UNREACH:
+        return None
+    code = packet[ihl + 1]
+    inner = packet[ihl + 8:]
+    inner_ihl = (inner[0] & 0xf) * 4
+    if inner[9] != UDP_PROTO or len(inner) < inner_ihl + 4:
+        return None
+    dst = socket.inet_ntoa(inner[16:20])
+    src_port, dst_port = struct.unpack('!HH', inner[inner_ihl:inner_ihl + 4])
+    return code, dst, src_port, dst_port
+
+def scan_ports_udp(addr, start, end, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES,
+                   rate=DEFAULT_RATE, batch=DEFAULT_UDP_BATCH, done=()):
+    '''
+    Сканирует UDP порты без потоков: все пробы уходят с одного сокета
+    пачками по batch штук, между пачками и после них читаются ответы.
+    Пришел UDP ответ - порт открыт, ICMP port unreachable (читается с raw
+    сокета, нужен root) - закрыт, другой ICMP unreachable - фильтруется.
+    Молчащим портам пробы повторяются еще retries раундов, после чего
+    они считаются open|filtered. Порты из done пропускаются.
+    '''
+    addr = socket.gethostbyname(addr)
+    limiter = RateLimiter(rate) if rate else None
+    udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        icmp = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+    except PermissionError:
+        icmp = None
+        print('No permission for a raw socket, closed ports will be reported '
+              'as open|filtered. Use sudo.', file=sys.stderr)
+
+    with udp:
+        udp.bind(('', 0))
+        local_port = udp.getsockname()[1]
+        socks = [udp] + ([icmp] if icmp else [])
+        pending = set(port for port in range(start, end + 1) if port not in done)
+        sent = {}
+
+        def drain(wait):
+            '''
+            Читает все пришедшие ответы, ожидая не дольше wait секунд.
+            '''
+            deadline = time.monotonic() + wait
+            while pending:
+                r, *_ = select.select(socks, [], [], max(0, deadline - time.monotonic()))
+                if not r:
+                    return
+                for sock in r:
+                    data, (src, port) = sock.recvfrom(65536)
+                    now = time.monotonic()
+                    if sock is udp:
+                        if src != addr or port not in pending:
+                            continue
+                        state = 'open'
+                    else:
+                        unreach = parse_icmp_unreach(data)
+                        if not unreach:
+                            continue
+                        code, dst, src_port, port = unreach
+                        if dst != addr or src_port != local_port or port not in pending:
+                            continue
+                        state = 'closed' if code == ICMP_PORT_UNREACH else 'filtered'
+                    pending.remove(port)
+                    info = PortInfo(addr, port, state, now - sent[port])
+                    if state == 'open':
+                        info.service = match_protocol(data, UDP_PROTOCOL_CHECKS)
+                    yield info
+
+        try:
+            for _ in range(retries + 1):
+                ports = sorted(pending)
+                for idx in range(0, len(ports), batch):
+                    for port in ports[idx:idx + batch]:
+                        if port not in pending:
+                            continue
+                        if limiter:
+                            limiter.acquire()
+                        sent[port] = time.monotonic()
+                        udp.sendto(UDP_PORT_PAYLOADS.get(port, b''), (addr, port))
+                    yield from drain(0)
+                yield from drain(timeout)
+        finally:
+            if icmp:
+                icmp.close()
+
+        for port in sorted(pending):
+            yield PortInfo(addr, port, 'open|filtered')
+
+class CheckpointError(Exception):
+    pass
+
+class Bitmap(object):
+    '''
+    Множество портов из диапазона [start, end], по биту на порт.
+    '''
+    def __init__(self, start, end, bits=None):
+        self.start = start
+        self.bits = bytearray(bits) if bits else bytearray((end - start) // 8 + 1)
+
+    def add(self, port):
+        idx = port - self.start
+        self.bits[idx >> 3] |= 1 << (idx & 7)
+
+    def __contains__(self, port):
+        idx = port - self.start
+        return bool(self.bits[idx >> 3] & (1 << (idx & 7)))
+
+    def dump(self):
+        # карты обычно почти пустые или почти полные, поэтому хорошо сжимаются
+        return base64.b64encode(zlib.compress(bytes(self.bits))).decode('ascii')
+
+    @staticmethod
+    def load(start, end, text):
+        return Bitmap(start, end, zlib.decompress(base64.b64decode(text)))
+
+class Checkpoint(object):
+    '''
+    Состояние сканирования на диске. Для каждого хоста хранится битовая
+    карта проверенных портов, по карте на каждое состояние кроме open
+    и подробные результаты по открытым портам.
+    Сохраняется не чаще раза в CHECKPOINT_INTERVAL секунд, через временный
+    файл, чтобы прерывание во время записи не испортило предыдущее состояние.
+    '''
+    def __init__(self, path, udp, start, end):
+        self.path = path
+        self.udp = udp
+        self.start = start
+        self.end = end
+        self.hosts = {}
+        self.last_save = time.monotonic()
+
+    def host(self, addr):
+        if addr not in self.hosts:
+            self.hosts[addr] = {
+                'done': Bitmap(self.start, self.end),
+                'states': {},
+                'open': []
+            }
+        return self.hosts[addr]
+
+    def add(self, info):
+        host = self.host(info.addr)
+        host['done'].add(info.port)
+        if info.state == 'open':
+            host['open'].append(info.as_dict())
+        else:
+            if info.state not in host['states']:
+                host['states'][info.state] = Bitmap(self.start, self.end)
+            host['states'][info.state].add(info.port)
+        if time.monotonic() - self.last_save >= CHECKPOINT_INTERVAL:
+            self.save()
+
+    def replay(self, addr):
+        '''
+        Отдает результаты, сохраненные для хоста в прошлый раз.
+        '''
+        host = self.host(addr)
+        for res in host['open']:
+            info = PortInfo(addr, res['port'], res['state'])
+            info.rtt = res['rtt'] / 1000 if res['rtt'] is not None else None
+            info.service = res['service']
+            yield info
+        for port in range(self.start, self.end + 1):
+            for state, bitmap in host['states'].items():
+                if port in bitmap:
+                    yield PortInfo(addr, port, state)
+                    break
+
+    def save(self):
+        state = {
+            'version': CHECKPOINT_VERSION,
+            'udp': self.udp,
+            'start': self.start,
+            'end': self.end,
+            'hosts': {
+                addr: {
+                    'done': host['done'].dump(),
+                    'states': {k: v.dump() for k, v in host['states'].items()},
+                    'open': host['open']
+                }
+                for addr, host in self.hosts.items()
+            }
+        }
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.path)
+        self.last_save = time.monotonic()
+
+    @staticmethod
+    def load(path, udp, start, end):
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except (OSError, ValueError) as e:
+            raise CheckpointError('Can\'t read checkpoint {}: {}'.format(path, e))
+        if state.get('version') != CHECKPOINT_VERSION or \
+                (state['udp'], state['start'], state['end']) != (udp, start, end):
+            raise CheckpointError(
+                'Checkpoint {} was made for another scan: {} {}-{}'.format(
+                    path, 'UDP' if state.get('udp') else 'TCP',
+                    state.get('start'), state.get('end')
+                )
+            )
+        checkpoint = Checkpoint(path, udp, start, end)
+        for addr, host in state['hosts'].items():
+            checkpoint.hosts[addr] = {
+                'done': Bitmap.load(start, end, host['done']),
+                'states': {
+                    k: Bitmap.load(start, end, v) for k, v in host['states'].items()
+                },
+                'open': host['open']
+            }
+        return checkpoint
+
+def output_result(info, fmt, writer=None):
+    '''
+    Печатает результат проверки порта в выбранном формате. Вывод сразу
+    сбрасывается, чтобы результаты можно было обрабатывать через pipe
+    по мере сканирования.
+    '''
+    if fmt == 'text':
+        service = ' ({})'.format(info.service) if info.service else ''
+        print(info.port, 'is', ('opened' if info.state == 'open' else info.state) + service)
+    elif fmt == 'json':
+        print(json.dumps(info.as_dict()))
+    else:
+        writer.writerow(info.as_dict())
+    sys.stdout.flush()
 
 def main():
     parser = argparse.ArgumentParser(
-        description='Portscan. TCP only.',
-        epilog='Usage example: portscam.py google.com 21 80'
+        description='Portscan. TCP and UDP.',
+        epilog='Usage example: portscam.py google.com 21 80 -f json'
     )
     parser.add_argument(
-        'address', type=str,
-        help='address to scan')
+        '-u', action='store_true',
+        help='UDP scan. Needs root to tell closed ports from silent ones'
+    )
+    parser.add_argument(
+        '-b', metavar='batch', type=int, default=DEFAULT_UDP_BATCH,
+        help='UDP probes sent between reading replies. Default: {}'.format(DEFAULT_UDP_BATCH)
+    )
+    parser.add_argument(
+        'address', type=str, nargs='+',
+        help='addresses to scan')
     parser.add_argument(
         'start', type=int,
         help='starting port'
     )
     parser.add_argument(
         'end', type=int,
-        help='end port'#. Ignored if --proto is present(only start port will be checked).'
+        help='end port'
+    )
+    parser.add_argument(
+        '-f', metavar='format', choices=OUTPUT_FORMATS, default='text',
+        help='output format: text, json (JSON lines) or csv. '
+             'RTT is in milliseconds. Default: text'
+    )
+    parser.add_argument(
+        '-a', action='store_true',
+        help='report closed, filtered and failed ports too'
+    )
+    parser.add_argument(
+        '-w', metavar='workers', type=int, default=DEFAULT_WORKERS,
+        help='number of concurrent connection attempts. Default: {}'.format(DEFAULT_WORKERS)
+    )
+    parser.add_argument(
+        '-t', metavar='timeout', type=float, default=DEFAULT_TIMEOUT,
+        help='connect timeout in seconds. Default: {}'.format(DEFAULT_TIMEOUT)
+    )
+    parser.add_argument(
+        '-r', metavar='retries', type=int, default=DEFAULT_RETRIES,
+        help='extra attempts for ports that did not answer. Default: {}'.format(DEFAULT_RETRIES)
+    )
+    parser.add_argument(
+        '--rate', metavar='pps', type=int, default=DEFAULT_RATE,
+        help='max connection attempts per second, 0 for no limit. '
+             'Lowered automatically when timeouts spike. Default: {}'.format(DEFAULT_RATE)
+    )
+    parser.add_argument(
+        '-q', action='store_true',
+        help='do not show progress'
+    )
+    parser.add_argument(
+        '--proto', action='store_true',
+        help='identify HTTP, SMTP, POP3, DNS and NTP on open ports. '
+             'Always on for UDP scan'
+    )
+    parser.add_argument(
+        '--proto-workers', metavar='workers', type=int, default=DEFAULT_PROBE_WORKERS,
+        help='number of ports probed for protocols at once. Default: {}'.format(
+            DEFAULT_PROBE_WORKERS
+        )
+    )
+    parser.add_argument(
+        '--checkpoint', metavar='file', type=str,
+        help='periodically save scan state to this file'
+    )
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='continue the scan saved in --checkpoint file'
     )
-    #parser.add_argument('--proto', action='store_const', const=True)
     args = parser.parse_args()
-    # if args.proto:
-    #     protocols = check_protocols(args.address, address.start)
-    # else:
-    for port in scan_ports(args.address, args.start, args.end):
-        print(port, 'is opened')
+    if args.resume and not args.checkpoint:
+        parser.error('--resume requires --checkpoint')
+
+    checkpoint = None
+    if args.resume:
+        try:
+            checkpoint = Checkpoint.load(args.checkpoint, args.u, args.start, args.end)
+        except CheckpointError as e:
+            print('ERROR:', e, file=sys.stderr)
+            return
+    elif args.checkpoint:
+        checkpoint = Checkpoint(args.checkpoint, args.u, args.start, args.end)
+
+    writer = None
+    if args.f == 'csv':
+        writer = csv.DictWriter(sys.stdout, CSV_FIELDS)
+        writer.writeheader()
+    progress = None
+    if not args.q and sys.stderr.isatty():
+        progress = Progress((args.end + 1 - args.start) * len(args.address))
+
+    def report(info):
+        if info.state == 'open' or args.a:
+            if progress:
+                progress.clear()
+            output_result(info, args.f, writer)
+        if progress:
+            progress.update(info)
+
+    try:
+        for address in args.address:
+            addr = socket.gethostbyname(address)
+            done = ()
+            if checkpoint:
+                for info in checkpoint.replay(addr):
+                    report(info)
+                done = checkpoint.host(addr)['done']
+            if args.u:
+                scan = scan_ports_udp(
+                    addr, args.start, args.end,
+                    timeout=args.t, retries=args.r, rate=args.rate, batch=args.b, done=done
+                )
+            else:
+                scan = scan_ports(
+                    addr, args.start, args.end,
+                    workers=args.w, timeout=args.t, retries=args.r, rate=args.rate,
+                    proto=args.proto, proto_workers=args.proto_workers, done=done
+                )
+            for info in scan:
+                if checkpoint:
+                    checkpoint.add(info)
+                report(info)
+    except KeyboardInterrupt:
+        if checkpoint:
+            print('\nInterrupted. Run again with --resume to continue.', file=sys.stderr)
+    finally:
+        if checkpoint:
+            checkpoint.save()
+        if progress:
+            progress.finish()
 
 if __name__ == '__main__':
     main()
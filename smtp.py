@@ -3,20 +3,59 @@ import ssl
 import sys
 import glob
 import os.path
-import re
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
 from argparse import ArgumentParser
-from base64 import b64encode
+from base64 import b64encode, encodebytes
 
 EHLO = 'oleg.oleg'
 DEFAULT_FROM = 'oleg@mail.ru'
 PICTURE_EXTENSIONS = ['/*.png', '/*.jpg', '/*.bmp']
 SSL_PORT = 465
 BOUNDARY = 'Oleg'
-SIZE_RE = re.compile(rb'SIZE[^\d]+(\d+)')
+RECV_SIZE = 65536
+# столько байт кодируется в одну строку base64 из 76 символов
+BASE64_LINE = 57
+READ_SIZE = BASE64_LINE * 1024
+# размер куска тела письма в BDAT
+BDAT_SIZE = 1 << 20
+# сколько команд держать без ответа при PIPELINING
+PIPELINE_DEPTH = 16
+DEFAULT_SESSIONS = 4
 
 class SMTPException(Exception):
     pass
 
+class ConnectionLost(SMTPException):
+    '''
+    Соединение оборвалось или ответы сервера больше не разобрать,
+    сессией пользоваться нельзя.
+    '''
+    pass
+
+class ServiceClosing(ConnectionLost):
+    '''
+    Сервер ответил 421 и закрывает соединение.
+    '''
+    pass
+
+class MessageRejected(SMTPException):
+    '''
+    Сервер отказался принять письмо, но сессия жива.
+    '''
+    pass
+
+def tls_context():
+    '''
+    Контекст TLS, как у прежнего ssl.wrap_socket: сертификат сервера не
+    проверяется.
+    '''
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
 def log(preamble, msg):
     if isinstance(msg, bytes) or isinstance(msg, bytearray):
         msg = msg.decode('utf8')
@@ -28,6 +67,92 @@ def log(preamble, msg):
     )
     sys.stderr.write('\r\n')
 
+def base64_size(size):
+    '''
+    Длина base64 для size байт, со строками по 76 символов и \r\n
+    в конце каждой.
+    '''
+    return 4 * ((size + 2) // 3) + 2 * ((size + BASE64_LINE - 1) // BASE64_LINE)
+
+def base64_file(path):
+    '''
+    Читает файл кусками и отдает его в base64 строками по 76 символов.
+    Куски кратны BASE64_LINE, поэтому строки не рвутся на их стыках.
+    '''
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(READ_SIZE)
+            if not chunk:
+                return
+            yield encodebytes(chunk).replace(b'\n', b'\r\n')
+
+class Message(object):
+    '''
+    Письмо с картинками во вложениях. Целиком в памяти не собирается:
+    chunks читает файлы по кускам, а размер считается заранее по размерам
+    файлов.
+    '''
+    def __init__(self, from_, to, pictures):
+        self.parts = [b'\r\n'.join([
+            'From: Oleg <{}>'.format(from_).encode('ascii'),
+            'To: Oleg <{}>'.format(to).encode('ascii'),
+            'Subject: {}'.format(BOUNDARY).encode('ascii'),
+            'Content-Type: multipart/related; boundary={}'.format(BOUNDARY).encode('ascii'),
+            b'',
+            b'',
+            '--{}'.format(BOUNDARY).encode('ascii'),
+            b'Content-Type: text/html; charset=ascii',
+            b'',
+            b'Oleg',
+            b''
+        ])]
+        for picture in pictures:
+            filename = os.path.basename(picture)
+            self.parts.append(b'\r\n'.join([
+                '--{}'.format(BOUNDARY).encode('ascii'),
+                'Content-Type: image/{}'.format(filename.split('.')[-1]).encode('utf8'),
+                b'Content-Transfer-Encoding: base64',
+                'Content-Disposition: attachment; filename="{}"'.format(filename).encode('utf8'),
+                b'',
+                b''
+            ]))
+            # путь к файлу вместо данных
+            self.parts.append(picture)
+        self.parts.append('--{}--\r\n'.format(BOUNDARY).encode('ascii'))
+
+    def __len__(self):
+        return sum(
+            len(part) if isinstance(part, bytes) else base64_size(os.path.getsize(part))
+            for part in self.parts
+        )
+
+    def chunks(self):
+        for part in self.parts:
+            if isinstance(part, bytes):
+                yield part
+            else:
+                yield from base64_file(part)
+
+def rechunk(chunks, size):
+    '''
+    Склеивает куски в куски не меньше size байт, кроме последнего.
+    '''
+    buf = bytearray()
+    for chunk in chunks:
+        buf += chunk
+        if len(buf) >= size:
+            yield bytes(buf)
+            buf.clear()
+    if buf:
+        yield bytes(buf)
+
+def describe(reply):
+    '''
+    Ответ сервера одной строкой для сообщений об ошибках.
+    '''
+    code, lines = reply
+    return '{} {}'.format(code, ' '.join(lines)).strip()
+
 class Smtp(object):
     '''
     Обертка над протоколом SMTP.
@@ -35,8 +160,17 @@ class Smtp(object):
     def __init__(self):
         self.sock = socket.socket()
         self.sock.settimeout(3)
-        self.helo = None
+        # расширения из ответа на EHLO: имя -> параметры
+        self.extensions = {}
         self.connected = False
+        # принятые, но еще не разобранные данные
+        self.buffer = bytearray()
+        self.chunk = bytearray(RECV_SIZE)
+        self.chunk_view = memoryview(self.chunk)
+        # сколько писем отправлено в этой сессии
+        self.transactions = 0
+        # тело текущего письма уже начало уходить серверу
+        self.body_sent = False
 
     def connect(self, addr, port):
         '''
@@ -44,46 +178,53 @@ class Smtp(object):
         защищенное соединение.
         '''
         if port == SSL_PORT:
-            self.sock = ssl.wrap_socket(self.sock)
+            self.sock = tls_context().wrap_socket(self.sock, server_hostname=addr)
         try:
             self.sock.connect((addr, port))
         except socket.timeout:
             raise SMTPException('Couldn\'t connect to {}:{}'.format(addr, port))
-        log('s: ', self.sock.recv(1024))
-        ans = self.ehlo()
-        if b'STARTTLS' in ans:
-            ans = self.send_and_receive_one_line(b'STARTTLS\r\n')
-            self.sock = ssl.wrap_socket(self.sock)
-            ans = self.ehlo()
-            log('s: ', ans)
-        self.helo = ans
+        greeting = self.receive_reply()
+        if greeting[0] != 220:
+            raise SMTPException('Server refused connection: {}'.format(describe(greeting)))
+        self.ehlo()
+        if self.has_extension('STARTTLS'):
+            code, _ = self.send_and_receive(b'STARTTLS\r\n')
+            if code == 220:
+                # все, что пришло до рукопожатия, могло быть подложено (RFC 3207)
+                self.buffer.clear()
+                self.sock = tls_context().wrap_socket(self.sock, server_hostname=addr)
+                self.ehlo()
         self.connected = True
 
     def ehlo(self):
-        ehlo = 'EHLO {}\r\n'.format(EHLO).encode('utf8')
-        log('c: ', ehlo)
-        self.sock.send(ehlo)
-        ans = bytearray()
-        while not ans or not ans.split(b'\r\n')[-2][3] != b' ':
-            ans += self.sock.recv(1024)
-
-        log('s: ', ans)
-        return ans
+        '''
+        Шлет EHLO и запоминает расширения сервера, по одному на строку
+        ответа после первой.
+        '''
+        reply = self.send_and_receive('EHLO {}\r\n'.format(EHLO).encode('utf8'))
+        code, lines = reply
+        if code != 250:
+            raise SMTPException('EHLO failed: {}'.format(describe(reply)))
+        self.extensions = {}
+        for line in lines[1:]:
+            name, _, params = line.partition(' ')
+            self.extensions[name.upper()] = params
+        return reply
 
     def auth_login(self, login, password):
         '''
         Авторизуется используя команду AUTH LOGIN.
         '''
-        self.send_and_receive_one_line(b'AUTH LOGIN\r\n')
-        ans = self.send_and_receive_one_line(
+        self.send_and_receive(b'AUTH LOGIN\r\n')
+        code, _ = self.send_and_receive(
             b64encode(login.encode('utf8')) + b'\r\n'
         )
-        if not ans.startswith(b'334'):
+        if code != 334:
             raise SMTPException('Wrong login or password')
-        ans = self.send_and_receive_one_line(
+        code, _ = self.send_and_receive(
             b64encode(password.encode('utf8')) + b'\r\n'
         )
-        if not ans.startswith(b'235'):
+        if code != 235:
             raise SMTPException('Wrong login or password')
 
     def __enter__(self):
@@ -94,7 +235,7 @@ class Smtp(object):
 
     def close(self):
         if self.connected:
-            self.send_and_receive_one_line(b'QUIT\r\n')
+            self.send_and_receive(b'QUIT\r\n')
         self.sock.close()
 
     def auth_plain(self, login, password):
@@ -102,86 +243,309 @@ class Smtp(object):
         Авторизуется используя команду AUTH PLAIN.
         '''
         encoded = b64encode('\0{}\0{}'.format(login, password).encode('utf8'))
-        ans = self.send_and_receive_one_line('AUTH PLAIN {}\r\n'.format(encoded).encode('utf8'))
-        if not ans.startswith(b'235'):
+        code, _ = self.send_and_receive(b'AUTH PLAIN ' + encoded + b'\r\n')
+        if code != 235:
             raise SMTPException('Wrong login or password')
 
-    def send_and_receive_one_line(self, msg, log_send=True):
+    def send_and_receive(self, msg, log_send=True):
         '''
         Отправляет указанную команду, получает ответ.
-        Сигнал конца сообщения - \r\n
         '''
         if log_send:
             log('c: ', msg)
 
         self.sock.sendall(msg)
-        resp = bytearray()
+        return self.receive_reply()
+
+    def fill(self):
+        '''
+        Дочитывает данные из сокета в буфер.
+        '''
+        size = self.sock.recv_into(self.chunk)
+        if not size:
+            self.connected = False
+            raise ConnectionLost('Connection closed by server')
+        self.buffer += self.chunk_view[:size]
+
+    def receive_reply(self):
+        '''
+        Получает ответ целиком, в том числе многострочный: строки
+        "250-..." продолжают ответ, строка "250 ..." его завершает.
+        Возвращает (код, строки текста). Данные следующих ответов
+        остаются в буфере.
+        '''
+        lines = []
+        start = 0
         while True:
-            resp += self.sock.recv(1024)
-            if resp[-2:] == b'\r\n':
+            end = self.buffer.find(b'\r\n', start)
+            if end < 0:
+                self.fill()
+                continue
+            line = self.buffer[start:end]
+            start = end + 2
+            if len(line) < 3 or not line[:3].isdigit() or line[3:4] not in (b'', b' ', b'-'):
+                self.connected = False
+                raise ConnectionLost('Malformed reply: {}'.format(
+                    line.decode('utf8', 'replace')
+                ))
+            lines.append(line[4:].decode('utf8', 'replace'))
+            if line[3:4] != b'-':
                 break
+        log('s: ', self.buffer[:start])
+        del self.buffer[:start]
+        code = int(line[:3])
+        if code == 421:
+            self.connected = False
+            raise ServiceClosing(describe((code, lines)))
+        return code, lines
 
-        log('s: ', resp)
-        return resp
+    def has_extension(self, name):
+        '''
+        Объявил ли сервер расширение name в ответе на EHLO.
+        '''
+        return name in self.extensions
+
+    def pipeline(self, commands):
+        '''
+        Отправляет команды разом, если сервер поддерживает PIPELINING
+        (RFC 2920), иначе по одной, до первого отказа. Возвращает ответы
+        в порядке команд.
+        '''
+        if not self.has_extension('PIPELINING'):
+            replies = []
+            for command in commands:
+                replies.append(self.send_and_receive(command))
+                if replies[-1][0] >= 400:
+                    break
+            return replies
+        for command in commands:
+            log('c: ', command)
+        self.sock.sendall(b''.join(commands))
+        return [self.receive_reply() for _ in commands]
+
+    def send_chunks(self, chunks):
+        '''
+        Передает тело письма командами BDAT (RFC 3030): данные идут как
+        есть, без экранирования точек и поиска конца письма. При
+        PIPELINING на ответы не ждем, без ответа держим не больше
+        PIPELINE_DEPTH кусков. Возвращает ответ на последний BDAT.
+        '''
+        depth = PIPELINE_DEPTH if self.has_extension('PIPELINING') else 1
+        pending = 0
+        failed = None
+        for chunk in rechunk(chunks, BDAT_SIZE):
+            command = 'BDAT {}\r\n'.format(len(chunk)).encode('ascii')
+            log('c: ', command)
+            self.sock.sendall(command + chunk)
+            pending += 1
+            if pending >= depth:
+                reply = self.receive_reply()
+                pending -= 1
+                if failed is None and reply[0] != 250:
+                    failed = reply
+        # пустой последний кусок проще, чем заглядывать вперед
+        log('c: ', b'BDAT 0 LAST\r\n')
+        self.sock.sendall(b'BDAT 0 LAST\r\n')
+        for _ in range(pending + 1):
+            reply = self.receive_reply()
+            if failed is None and reply[0] != 250:
+                failed = reply
+        return failed or reply
 
     def auth(self, login, password):
         '''
         Пытается авторизоваться одним из доступных способов: PLAIN или LOGIN.
         '''
-        if b'LOGIN' in self.helo:
+        methods = self.extensions.get('AUTH', '').upper().split()
+        if 'LOGIN' in methods:
             self.auth_login(login, password)
-        elif b'PLAIN' in self.helo:
+        elif 'PLAIN' in methods:
             self.auth_plain(login, password)
         else:
             raise SMTPException('Server doesn\'t support LOGIN and PLAIN commands')
 
-    @staticmethod
-    def construct_message(from_, to, pictures):
-        msg = []
-        msg.append(b'\r\n'.join([
-            'From: Oleg <{}>'.format(from_).encode('ascii'),
-            'To: Oleg <{}>'.format(to).encode('ascii'),
-            'Subject: {}'.format(BOUNDARY).encode('ascii'),
-            'Content-Type: multipart/related; boundary={}'.format(BOUNDARY).encode('ascii'),
-            b'',
-            b'',
-            '--{}'.format(BOUNDARY).encode('ascii'),
-            b'Content-Type: text/html; charset=ascii',
-            b'',
-            b'Oleg',
-            b''
-        ]))
-        for pic_data, filename in pictures:
-            msg.append(b'\r\n'.join([
-                '--{}'.format(BOUNDARY).encode('ascii'),
-                'Content-Type: image/{}'.format(filename.split('.')[-1]).encode('utf8'),
-                b'Content-Transfer-Encoding: base64',
-                'Content-Disposition: attachment; filename="{}"'.format(filename).encode('utf8'),
-                b'',
-                b64encode(pic_data),
-                b''
-            ]))
-        msg.append('--{}--\r\n.\r\n'.format(BOUNDARY).encode('ascii'))
-        return b''.join(msg)
-
     def send_message(self, from_, to, pictures):
         '''
-        Отсылает все полученные изображения на указанную почту.
+        Отсылает все изображения из списка путей на указанную почту.
+        Письмо пишется в сокет по мере чтения файлов. Команды конверта
+        отправляются одним пакетом при PIPELINING, тело - через BDAT
+        при CHUNKING. Со второго письма в сессии транзакция начинается
+        с RSET, на случай если предыдущая оборвалась.
         '''
-        message = Smtp.construct_message(from_, to, pictures)
-        match = SIZE_RE.search(self.helo)
-        if match:
-            max_size = int(match.group(1).decode('ascii'))
-            if len(message) > max_size:
-                raise SMTPException('Message too long. Maximum length: {}'.format(max_size))
-        self.send_and_receive_one_line(
-            'MAIL FROM: <{}>\r\n'.format(from_).encode('ascii')
-        )
-        self.send_and_receive_one_line(
+        message = Message(from_, to, pictures)
+        size = len(message)
+        mail_from = 'MAIL FROM: <{}>'.format(from_)
+        if self.has_extension('SIZE'):
+            max_size = self.extensions['SIZE'].split()
+            max_size = int(max_size[0]) if max_size and max_size[0].isdigit() else 0
+            # SIZE 0 - ограничения нет (RFC 1870)
+            if max_size and size > max_size:
+                raise MessageRejected('Message too long. Maximum length: {}'.format(max_size))
+            mail_from += ' SIZE={}'.format(size)
+        chunking = self.has_extension('CHUNKING')
+        commands = [
+            '{}\r\n'.format(mail_from).encode('ascii'),
             'RCPT TO: <{}>\r\n'.format(to).encode('ascii')
-        )
-        self.send_and_receive_one_line(b'DATA\r\n')
-        self.send_and_receive_one_line(message, False)
+        ]
+        if not chunking:
+            commands.append(b'DATA\r\n')
+        reset = self.transactions > 0
+        if reset:
+            commands.insert(0, b'RSET\r\n')
+        self.transactions += 1
+        self.body_sent = False
+        replies = self.pipeline(commands)
+        if reset and replies.pop(0)[0] != 250:
+            raise SMTPException('Couldn\'t reset the session')
+        failed = next((reply for reply in replies[:2] if reply[0] != 250), None)
+        if chunking:
+            if failed:
+                raise MessageRejected('Server rejected the envelope: {}'.format(
+                    describe(failed)
+                ))
+            self.body_sent = True
+            reply = self.send_chunks(message.chunks())
+        else:
+            reply = replies[2] if len(replies) > 2 else None
+            if failed and reply and reply[0] == 354:
+                # DATA ушла в одном пакете с отвергнутым конвертом
+                self.send_and_receive(b'.\r\n')
+            if failed or reply[0] != 354:
+                raise MessageRejected('Server refused to accept the message: {}'.format(
+                    describe(failed or reply)
+                ))
+            self.body_sent = True
+            # строки base64 и заголовков не начинаются с точки, экранировать нечего
+            for chunk in message.chunks():
+                self.sock.sendall(chunk)
+            reply = self.send_and_receive(b'.\r\n', False)
+        if reply[0] != 250:
+            raise MessageRejected('Message was not accepted: {}'.format(
+                describe(reply)
+            ))
+
+class SessionPool(object):
+    '''
+    Авторизованные сессии к одному серверу, не больше size сразу.
+    Сессия после письма возвращается в пул и отправляет следующие;
+    оборванные сессии выбрасываются, вместо них открываются новые.
+    '''
+    def __init__(self, addr, port, login=None, password=None, size=DEFAULT_SESSIONS):
+        self.addr = addr
+        self.port = port
+        self.login = login
+        self.password = password
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def open_session(self):
+        smtp = Smtp()
+        try:
+            smtp.connect(self.addr, self.port)
+            if self.login and self.password:
+                smtp.auth(self.login, self.password)
+        except (SMTPException, OSError):
+            smtp.close()
+            raise
+        return smtp
+
+    def acquire(self):
+        self.slots.acquire()
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self.open_session()
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, smtp):
+        self.idle.put(smtp)
+        self.slots.release()
+
+    def discard(self, smtp):
+        # сессия мертва, QUIT не шлем
+        smtp.connected = False
+        try:
+            smtp.close()
+        except (SMTPException, OSError):
+            pass
+        self.slots.release()
+
+    def send_message(self, from_, to, pictures):
+        '''
+        Отправляет письмо через свободную сессию. Сессия возвращается
+        в пул, только если письмо отправлено или отвергнуто ответом
+        сервера; после любой другой ошибки она выбрасывается. Письмо
+        отправляется еще раз через новую сессию, если сервер ответил 421
+        или связь пропала до отправки тела: после тела письмо могло
+        уже быть принято, и повтор доставил бы его дважды.
+        '''
+        for attempt in range(2):
+            smtp = self.acquire()
+            try:
+                smtp.send_message(from_, to, pictures)
+            except MessageRejected:
+                self.release(smtp)
+                raise
+            except (SMTPException, OSError) as e:
+                self.discard(smtp)
+                if attempt or (smtp.body_sent and not isinstance(e, ServiceClosing)):
+                    raise
+                continue
+            except BaseException:
+                self.discard(smtp)
+                raise
+            self.release(smtp)
+            return
+
+    def close(self):
+        while True:
+            try:
+                smtp = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                smtp.close()
+            except (SMTPException, OSError):
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def bulk_send(pool, from_, recipients, pictures):
+    '''
+    Отправляет письмо каждому получателю через сессии пула, параллельно.
+    Отдает пары (получатель, ошибка или None) по мере отправки.
+    '''
+    def send(to):
+        try:
+            pool.send_message(from_, to, pictures)
+        except Exception as e:
+            # например, не-ASCII адрес: это ошибка одного получателя,
+            # остальные отправляются и получают свой результат
+            return to, e
+        return to, None
+
+    with ThreadPoolExecutor(pool.size) as executor:
+        yield from executor.map(send, recipients)
+
+def read_recipients(filename):
+    '''
+    Читает адреса из файла, по одному в строке. Пустые строки и
+    строки, начинающиеся с #, пропускаются.
+    '''
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield line
 
 def main():
     parser = ArgumentParser(
@@ -198,23 +562,37 @@ def main():
     )
     parser.add_argument('-u', metavar='username', type=str, help='SMTP username')
     parser.add_argument('-p', metavar='password', type=str, help='SMTP password')
+    parser.add_argument(
+        '-l', metavar='file', type=str,
+        help='file with more recipients, one per line; each gets its own message'
+    )
+    parser.add_argument(
+        '-c', metavar='sessions', type=int, default=DEFAULT_SESSIONS,
+        help='connections at once when sending to many recipients. '
+             'Default: {}'.format(DEFAULT_SESSIONS)
+    )
     args = parser.parse_args()
 
     pictures = []
     for ext in PICTURE_EXTENSIONS:
-        for picture in glob.glob(args.directory + ext):
-            with open(picture, 'rb') as f:
-                data = f.read()
-            pictures.append((data, os.path.basename(picture)))
+        pictures.extend(glob.glob(args.directory + ext))
 
-    smtp = Smtp()
+    from_ = args.u if args.u and args.p else args.s
+    if args.l:
+        recipients = [args.recipient]
+        recipients.extend(read_recipients(args.l))
+        with SessionPool(args.server, args.port, args.u, args.p, args.c) as pool:
+            for to, error in bulk_send(pool, from_, recipients, pictures):
+                if error:
+                    print('{}: ERROR: {}'.format(to, error))
+                else:
+                    print('{}: sent'.format(to))
+        return
 
     with Smtp() as smtp:
         try:
             smtp.connect(args.server, args.port)
-            from_ = args.s
             if args.u and args.p:
-                from_ = args.u
                 smtp.auth(args.u, args.p)
             smtp.send_message(from_, args.recipient, pictures)
         except SMTPException as e:
@@ -2,59 +2,219 @@ import socket
 import struct
 import select
 import time
-import threading
 import datetime
+import os
+import signal
+import multiprocessing
 import argparse
 
 PURT = 123
 PUCKET_FURMAT = '>BBBbIIIIIIIIIII'
+PUCKET = struct.Struct(PUCKET_FURMAT)
+PUCKET_LEN = PUCKET.size
+TIMESTAMP = struct.Struct('>II')
+TRANS_TMSTP_OFFSET = 40
+# в ответе от запроса к запросу меняются только флаги и временные метки,
+# Transmit Timestamp ставится отдельно, прямо перед отправкой
+REPLY_FLAGS = struct.Struct('>B')
+REPLY_TIMESTAMPS = struct.Struct('>IIIIII')
+REPLY_TIMESTAMPS_OFFSET = 16
+NS_IN_SEC = 10**9
+# в модуле socket этих констант нет, значения из linux/asm-generic/socket.h
+SO_TIMESTAMP = getattr(socket, 'SO_TIMESTAMP', 29)
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35)
+# struct timespec и struct timeval - это два long
+KERNEL_TIMESTAMP = struct.Struct('@ll')
 # в UNIX времени отсчет идет с 1970 года, а в NTP 1900, поэтому нужно посчитать разницу
 SHUFT = int((datetime.datetime(1970, 1, 1) - datetime.datetime(1900, 1, 1)).total_seconds())
 REF_ID = 1337
+# сколько датаграмм максимум обрабатывается за одно пробуждение
+RECV_BATCH = 256
+# ограничение запросов с одного адреса: в среднем DEFAULT_CLIENT_RATE
+# в секунду, но не больше CLIENT_BURST подряд
+DEFAULT_CLIENT_RATE = 1
+CLIENT_BURST = 8
+# Kiss-o'-Death шлется нарушителю не чаще раза в KOD_INTERVAL секунд,
+# остальные его запросы молча отбрасываются
+KOD_INTERVAL = 10
+KOD_RATE = struct.unpack('>I', b'RATE')[0]
+# LI = 3 (часы не синхронизированы), mode = 4 (server)
+KOD_FLAGS = (3 << 6) + 4
+ORIG_TMSTP_OFFSET = 24
+# раз в сколько секунд чистить таблицу клиентов и печатать счетчики
+STATS_INTERVAL = 60
+ANSWER, KISS, DROP = range(3)
 
 class InvalidPacketException(Exception):
     pass
 
+def ntp_time(ns):
+    '''
+    Переводит время UNIX в наносекундах во время NTP: секунды и доли
+    секунды в единицах 1/2**32. Считается в целых числах, без потери
+    точности на float.
+    '''
+    sec, ns = divmod(ns, NS_IN_SEC)
+    return sec + SHUFT, (ns << 32) // NS_IN_SEC
+
 def parse_ntp_packet(data):
     '''
     Проверяет на корректность режим и возвращает версию и Transmit Timestamp.
+    Остальные поля запроса не нужны, поэтому и не разбираются.
     '''
-    try:
-        flags, *other = struct.unpack(PUCKET_FURMAT, data)
-    except ValueError:
+    if len(data) < PUCKET_LEN:
         raise InvalidPacketException()
-    trans_tmstp = (other[-2], other[-1])
+    flags = data[0]
     ver = (flags >> 3) % 8
     mode = flags % 8
     if ver > 4 or mode != 3:
         raise InvalidPacketException()
-    return ver, trans_tmstp
+    return ver, TIMESTAMP.unpack_from(data, TRANS_TMSTP_OFFSET)
+
+class ClientBucket(object):
+    '''
+    Token bucket одного клиента: сколько запросов ему еще можно
+    и когда ему последний раз отправлялся Kiss-o'-Death.
+    '''
+    def __init__(self, now, burst):
+        self.tokens = burst
+        self.time = now
+        self.last_kod = None
 
 class NTPServer(object):
-    def __init__(self, shift):
+    def __init__(self, shift, rate=DEFAULT_CLIENT_RATE, workers=1):
         self.shift = shift
+        # 0 - без ограничения запросов с одного адреса. Если порт делят
+        # workers процессов, ядро выбирает процесс по хешу адресов и
+        # портов, и клиент, меняющий порт источника, попадает во все.
+        # Поэтому процессу достается своя доля и частоты, и запаса
+        # подряд: вместе они дают лимит r и CLIENT_BURST, а клиент с
+        # постоянным портом ограничен строже
+        self.rate = rate / workers
+        self.burst = max(1, CLIENT_BURST / workers)
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if workers > 1:
+            # несколько процессов слушают один порт, ядро делит между ними запросы
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        # заготовка ответа, постоянные поля заполняются один раз
+        self.reply = bytearray(PUCKET_LEN)
+        PUCKET.pack_into(self.reply, 0, 0, 1, 17, 0, 0, 0, REF_ID, 0, 0, 0, 0, 0, 0, 0, 0)
+        # заготовка Kiss-o'-Death: stratum 0 и код RATE вместо Reference ID
+        self.kod = bytearray(PUCKET_LEN)
+        PUCKET.pack_into(self.kod, 0, 0, 0, 17, 0, 0, 0, KOD_RATE, 0, 0, 0, 0, 0, 0, 0, 0)
+        self.clients = {}
+        self.stats = {'served': 0, 'kod': 0, 'dropped': 0, 'malformed': 0, 'errors': 0}
+        # (тип сообщения, множитель до наносекунд) для времени получения от ядра
+        self.kernel_tmstp = None
+
+    def enable_kernel_timestamps(self):
+        '''
+        Просит ядро отдавать время получения каждой датаграммы: так в
+        Receive Timestamp не попадает время, которое запрос пролежал
+        в очереди сокета. Если ядро не умеет, время берется после recvfrom.
+        '''
+        for opt, multiplier in ((SO_TIMESTAMPNS, 1), (SO_TIMESTAMP, 1000)):
+            try:
+                self.sock.setsockopt(socket.SOL_SOCKET, opt, 1)
+            except OSError:
+                continue
+            self.kernel_tmstp = (opt, multiplier)
+            return
+
+    def recv_request(self):
+        '''
+        Принимает датаграмму, возвращает ее, адрес отправителя и время
+        получения в наносекундах.
+        '''
+        if not self.kernel_tmstp:
+            request, addr = self.sock.recvfrom(65536)
+            return request, addr, time.time_ns()
+
+        request, ancdata, _, addr = self.sock.recvmsg(
+            65536, socket.CMSG_SPACE(KERNEL_TIMESTAMP.size)
+        )
+        opt, multiplier = self.kernel_tmstp
+        for level, type_, data in ancdata:
+            if level == socket.SOL_SOCKET and type_ == opt:
+                sec, frac = KERNEL_TIMESTAMP.unpack(data[:KERNEL_TIMESTAMP.size])
+                return request, addr, sec * NS_IN_SEC + frac * multiplier
+        return request, addr, time.time_ns()
 
     def listen(self):
         '''
-        Бесконечно пытается принять входящие соединения, в случае успеха
-        отвечает в отдельном потоке.
+        Бесконечно ждет запросов и отвечает на них в этом же потоке:
+        ответ - это 48 байт, поток на каждый запрос обходится дороже.
         '''
         self.sock.bind(('', PURT))
-        active_threads = []
+        self.sock.setblocking(False)
+        self.enable_kernel_timestamps()
+        last_stats = time.monotonic()
         while True:
             r, *_ = select.select([self.sock], [], [], 5)
             if r:
-                request, addr = self.sock.recvfrom(65536)
-                recv_tmstp = time.time()
-                recv_tmstp = (int(recv_tmstp) + SHUFT, int((recv_tmstp % 1) * 2**32))
-                thr = threading.Thread(target=self.answer, args=[request, addr, recv_tmstp])
-                active_threads.append(thr)
-                thr.start()
-            for thr in list(active_threads):
-                if not thr.is_alive():
-                    thr.join()
-                    active_threads.remove(thr)
+                self.serve_ready()
+            if time.monotonic() - last_stats > STATS_INTERVAL:
+                last_stats = time.monotonic()
+                self.forget_idle_clients()
+                self.print_stats()
+
+    def check_rate(self, ip):
+        '''
+        Решает, что делать с запросом от ip: ответить, отправить
+        Kiss-o'-Death или промолчать.
+        '''
+        if not self.rate:
+            return ANSWER
+        now = time.monotonic()
+        bucket = self.clients.get(ip)
+        if bucket is None:
+            bucket = self.clients[ip] = ClientBucket(now, self.burst)
+        bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.time) * self.rate)
+        bucket.time = now
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            return ANSWER
+        if bucket.last_kod is None or now - bucket.last_kod >= KOD_INTERVAL:
+            bucket.last_kod = now
+            return KISS
+        return DROP
+
+    def forget_idle_clients(self):
+        '''
+        Удаляет клиентов, у которых бакет уже успел бы наполниться:
+        для них новая запись ничем не отличается от старой.
+        '''
+        if not self.rate:
+            return
+        now = time.monotonic()
+        for ip, bucket in list(self.clients.items()):
+            if now - bucket.time > max(self.burst / self.rate, KOD_INTERVAL):
+                del self.clients[ip]
+
+    def print_stats(self):
+        print('[{}] served: {served}, kiss-o\'-death: {kod}, dropped: {dropped}, '
+              'malformed: {malformed}, errors: {errors}'.format(os.getpid(), **self.stats), flush=True)
+
+    def serve_ready(self):
+        '''
+        Вычитывает все пришедшие датаграммы (не больше RECV_BATCH, чтобы
+        не зависнуть под потоком запросов) и сразу на них отвечает.
+        '''
+        for _ in range(RECV_BATCH):
+            try:
+                request, addr, recv_ns = self.recv_request()
+            except (BlockingIOError, InterruptedError):
+                return
+            recv_tmstp = ntp_time(recv_ns)
+            try:
+                self.answer(request, addr, recv_tmstp)
+            except (BlockingIOError, InterruptedError):
+                # буфер отправки переполнен, клиент повторит запрос
+                pass
+            except OSError:
+                # например, подложенный адрес с портом 0 (EINVAL): из-за
+                # одной датаграммы сервер падать не должен
+                self.stats['errors'] += 1
 
     def answer(self, request, addr, recv_tmstp):
         '''
@@ -63,10 +223,28 @@ class NTPServer(object):
         try:
             ver, orig_tmstp = parse_ntp_packet(request)
         except InvalidPacketException:
+            self.stats['malformed'] += 1
+            return
+        verdict = self.check_rate(addr[0])
+        if verdict == DROP:
+            self.stats['dropped'] += 1
             return
-        answer = self.construct_ntp_packet(ver, recv_tmstp, orig_tmstp)
+        if verdict == KISS:
+            self.stats['kod'] += 1
+            answer = self.construct_kod_packet(ver, orig_tmstp)
+        else:
+            self.stats['served'] += 1
+            answer = self.construct_ntp_packet(ver, recv_tmstp, orig_tmstp)
         self.sock.sendto(answer, addr)
 
+    def construct_kod_packet(self, ver, orig_tmstp):
+        '''
+        Составляет Kiss-o'-Death с кодом RATE: клиент должен реже слать запросы.
+        '''
+        REPLY_FLAGS.pack_into(self.kod, 0, KOD_FLAGS + (ver << 3))
+        TIMESTAMP.pack_into(self.kod, ORIG_TMSTP_OFFSET, *orig_tmstp)
+        return self.kod
+
     def close(self):
         self.sock.close()
 
@@ -79,38 +257,76 @@ class NTPServer(object):
     def construct_ntp_packet(self, ver, recv_tmstp, orig_tmstp):
         '''
         Составляет корректный NTP-пакет с "неправильным" текущим временем.
+        Пакет собирается в заготовке self.reply, следующий вызов ее
+        перезапишет. Часы для Transmit Timestamp читаются последними,
+        чтобы между меткой и отправкой прошло как можно меньше времени.
         '''
-        current_time = time.time()
-        fields = (
-            (ver << 3) + 4,
-            1, 17, 0, 0, 0, REF_ID,
-            int(current_time) + SHUFT,              # Ref Timestamp
-            int((current_time % 1) * 2**32),
-            orig_tmstp[0],                          # Origin Timestamp
-            orig_tmstp[1],
+        REPLY_FLAGS.pack_into(self.reply, 0, (ver << 3) + 4)
+        REPLY_TIMESTAMPS.pack_into(
+            self.reply, REPLY_TIMESTAMPS_OFFSET,
+            recv_tmstp[0], recv_tmstp[1],           # Ref Timestamp
+            orig_tmstp[0], orig_tmstp[1],           # Origin Timestamp
             recv_tmstp[0] + self.shift,             # Receive Timestamp
-            recv_tmstp[1],
-            int(current_time) + SHUFT + self.shift, # Transmit Timestamp
-            int((current_time % 1) * 2**32),
+            recv_tmstp[1]
         )
-        return struct.pack(PUCKET_FURMAT, *fields)
+        sec, frac = ntp_time(time.time_ns())
+        TIMESTAMP.pack_into(
+            self.reply, TRANS_TMSTP_OFFSET, sec + self.shift, frac
+        )                                           # Transmit Timestamp
+        return self.reply
+
+def serve(shift, rate, workers=1):
+    with NTPServer(shift, rate, workers) as server:
+        try:
+            server.listen()
+        except PermissionError:
+            print('You do not have enough permissions to perform this action. Use sudo.')
+        except KeyboardInterrupt:
+            server.print_stats()
 
 def main():
     parser = argparse.ArgumentParser(
         description='NTP server with surprises.',
-        epilog='Usage example: sntp.py 30'
+        epilog='Usage example: sntp.py 30 -w 4'
     )
     parser.add_argument(
         'shift', type=int,
         help='time shift in seconds'
     )
+    parser.add_argument(
+        '-w', metavar='workers', type=int, default=1,
+        help='number of server processes sharing the port via SO_REUSEPORT. Default: 1'
+    )
+    parser.add_argument(
+        '-r', metavar='rate', type=float, default=DEFAULT_CLIENT_RATE,
+        help='average requests per second allowed from one address, '
+             '0 for no limit; the rate and burst are split evenly between workers. '
+             'Default: {}'.format(DEFAULT_CLIENT_RATE)
+    )
     args = parser.parse_args()
 
-    with NTPServer(args.shift) as server:
-        try:
-            server.listen()
-        except PermissionError:
-            print('You do not have enough permissions to perform this action. Use sudo.')
+    if args.w <= 1:
+        serve(args.shift, args.r)
+        return
+
+    # каждый процесс считает клиентов сам и берет свою долю лимита
+    workers = [
+        multiprocessing.Process(target=serve, args=(args.shift, args.r, args.w))
+        for _ in range(args.w)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        # Ctrl-C получают и воркеры, они печатают счетчики и выходят сами;
+        # тех, кому сигнал не дошел, останавливаем
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for worker in workers:
+            worker.join(1)
+            if worker.is_alive():
+                worker.terminate()
 
 if __name__ == '__main__':
     main()
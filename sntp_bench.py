@@ -0,0 +1,88 @@
+'''
+Микробенчмарк разбора запроса и сборки ответа в sntp.py: исходный
+вариант со struct.pack/unpack по форматной строке против
+предкомпилированного struct.Struct с pack_into/unpack_from.
+'''
+import struct
+import time
+from argparse import ArgumentParser
+
+import sntp
+
+def legacy_parse(data):
+    '''
+    Разбор запроса в том виде, в каком он был до struct.Struct.
+    '''
+    flags, *other = struct.unpack(sntp.PUCKET_FURMAT, data)
+    trans_tmstp = (other[-2], other[-1])
+    ver = (flags >> 3) % 8
+    mode = flags % 8
+    if ver > 4 or mode != 3:
+        raise sntp.InvalidPacketException()
+    return ver, trans_tmstp
+
+def legacy_construct(shift, ver, recv_tmstp, orig_tmstp):
+    '''
+    Сборка ответа в том виде, в каком она была до struct.Struct.
+    '''
+    current_time = time.time()
+    fields = (
+        (ver << 3) + 4,
+        1, 17, 0, 0, 0, sntp.REF_ID,
+        int(current_time) + sntp.SHUFT,
+        int((current_time % 1) * 2**32),
+        orig_tmstp[0],
+        orig_tmstp[1],
+        recv_tmstp[0] + shift,
+        recv_tmstp[1],
+        int(current_time) + sntp.SHUFT + shift,
+        int((current_time % 1) * 2**32),
+    )
+    return struct.pack(sntp.PUCKET_FURMAT, *fields)
+
+def measure(func, count):
+    '''
+    Возвращает, сколько раз в секунду выполняется func.
+    '''
+    start = time.perf_counter()
+    for _ in range(count):
+        func()
+    return count / (time.perf_counter() - start)
+
+def main():
+    parser = ArgumentParser(
+        description='Micro-benchmark of NTP request parsing and reply building.',
+        epilog='Usage example: sntp_bench.py -n 500000'
+    )
+    parser.add_argument(
+        '-n', metavar='count', type=int, default=200000,
+        help='packets per measurement. Default: 200000'
+    )
+    args = parser.parse_args()
+
+    request = struct.pack(
+        sntp.PUCKET_FURMAT, (4 << 3) | 3, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
+        *sntp.ntp_time(time.time_ns())
+    )
+
+    def legacy():
+        recv_tmstp = time.time()
+        recv_tmstp = (int(recv_tmstp) + sntp.SHUFT, int((recv_tmstp % 1) * 2**32))
+        ver, orig_tmstp = legacy_parse(request)
+        legacy_construct(0, ver, recv_tmstp, orig_tmstp)
+
+    with sntp.NTPServer(0) as server:
+        def current():
+            recv_tmstp = sntp.ntp_time(time.time_ns())
+            ver, orig_tmstp = sntp.parse_ntp_packet(request)
+            server.construct_ntp_packet(ver, recv_tmstp, orig_tmstp)
+
+        old_rate = measure(legacy, args.n)
+        new_rate = measure(current, args.n)
+
+    print('format string: {:>12,.0f} packets/s'.format(old_rate))
+    print('struct.Struct: {:>12,.0f} packets/s'.format(new_rate))
+    print('speedup:       {:>12.2f}x'.format(new_rate / old_rate))
+
+if __name__ == '__main__':
+    main()
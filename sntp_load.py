@@ -0,0 +1,215 @@
+'''
+Нагрузочный клиент для sntp.py: шлет mode 3 запросы с заданной
+частотой с многих портов, проверяет каждый ответ и считает
+ответы в секунду, потери и распределение задержек.
+Сервер нужно запускать без ограничения на клиента: sntp.py 0 -r 0
+'''
+import socket
+import select
+import time
+from argparse import ArgumentParser
+
+import sntp
+
+NS_IN_USEC = 1000
+# сколько ждать ответов после отправки последнего запроса
+GRACE_PERIOD = 1
+PERCENTILES = (50, 90, 99, 99.9)
+
+class InvalidReplyException(Exception):
+    pass
+
+def unix_ns(tmstp):
+    '''
+    Обратное к sntp.ntp_time: время NTP в наносекунды UNIX.
+    '''
+    sec, frac = tmstp
+    return (sec - sntp.SHUFT) * sntp.NS_IN_SEC + ((frac * sntp.NS_IN_SEC) >> 32)
+
+def parse_reply(data, ver):
+    '''
+    Разбирает ответ сервера так же, как sntp.parse_ntp_packet разбирает
+    запрос, но ждет mode 4. Возвращает stratum и метки Origin, Receive,
+    Transmit.
+    '''
+    if len(data) < sntp.PUCKET_LEN:
+        raise InvalidReplyException()
+    flags, stratum, *other = sntp.PUCKET.unpack_from(data)
+    if (flags >> 3) % 8 != ver or flags % 8 != 4:
+        raise InvalidReplyException()
+    return stratum, (other[-6], other[-5]), (other[-4], other[-3]), (other[-2], other[-1])
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+class LoadGenerator(object):
+    def __init__(self, server, port, sockets, ver, shift):
+        self.server = (server, port)
+        self.ver = ver
+        self.shift_ns = shift * sntp.NS_IN_SEC
+        self.socks = []
+        for _ in range(sockets):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            # у каждого сокета свой порт источника
+            sock.connect(self.server)
+            self.socks.append(sock)
+        self.request = bytearray(sntp.PUCKET_LEN)
+        sntp.REPLY_FLAGS.pack_into(self.request, 0, (ver << 3) + 3)
+        # Transmit Timestamp запроса -> время отправки; сервер вернет его в Origin
+        self.outstanding = {}
+        self.sent = 0
+        self.replies = 0
+        self.kod = 0
+        self.invalid = 0
+        self.one_way = []
+        self.processing = []
+        self.rtt = []
+        self.elapsed = 0
+
+    def close(self):
+        for sock in self.socks:
+            sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def send(self):
+        sock = self.socks[self.sent % len(self.socks)]
+        send_ns = time.time_ns()
+        tmstp = sntp.ntp_time(send_ns)
+        # метки должны быть уникальны, по ним ищется запрос
+        while tmstp in self.outstanding:
+            send_ns += 1
+            tmstp = sntp.ntp_time(send_ns)
+        sntp.TIMESTAMP.pack_into(self.request, sntp.TRANS_TMSTP_OFFSET, *tmstp)
+        try:
+            sock.send(self.request)
+        except (BlockingIOError, InterruptedError):
+            return
+        self.outstanding[tmstp] = send_ns
+        self.sent += 1
+
+    def receive(self, wait):
+        r, *_ = select.select(self.socks, [], [], wait)
+        for sock in r:
+            while True:
+                try:
+                    data = sock.recv(65536)
+                except (BlockingIOError, InterruptedError, ConnectionRefusedError):
+                    break
+                self.handle(data, time.time_ns())
+
+    def handle(self, data, recv_ns):
+        try:
+            stratum, orig, server_recv, server_trans = parse_reply(data, self.ver)
+        except InvalidReplyException:
+            self.invalid += 1
+            return
+        send_ns = self.outstanding.pop(orig, None)
+        if send_ns is None:
+            self.invalid += 1
+            return
+        self.replies += 1
+        if stratum == 0:
+            self.kod += 1
+            return
+        server_recv = unix_ns(server_recv) - self.shift_ns
+        server_trans = unix_ns(server_trans) - self.shift_ns
+        self.one_way.append(server_recv - send_ns)
+        self.processing.append(server_trans - server_recv)
+        self.rtt.append(recv_ns - send_ns - (server_trans - server_recv))
+
+    def run(self, rate, duration):
+        '''
+        Шлет rate запросов в секунду в течение duration секунд, затем
+        еще GRACE_PERIOD секунд ждет опоздавшие ответы.
+        '''
+        start = time.monotonic()
+        end = start + duration
+        try:
+            while True:
+                now = time.monotonic()
+                if now >= end:
+                    break
+                due = int((now - start) * rate) + 1 - self.sent
+                for _ in range(due):
+                    self.send()
+                self.receive(min(1 / rate, end - now))
+        finally:
+            self.elapsed = time.monotonic() - start
+        grace_end = time.monotonic() + GRACE_PERIOD
+        while self.outstanding and time.monotonic() < grace_end:
+            self.receive(grace_end - time.monotonic())
+
+    def report(self):
+        lost = self.sent - self.replies
+        print('sent:      {}'.format(self.sent))
+        print('replies:   {} ({:.0f}/s)'.format(
+            self.replies, self.replies / self.elapsed if self.elapsed else 0
+        ))
+        print('lost:      {} ({:.2f}%)'.format(lost, 100 * lost / self.sent if self.sent else 0))
+        print('kiss-o\'-death: {}, invalid: {}'.format(self.kod, self.invalid))
+        for name, values in (
+                ('receive - origin', self.one_way),
+                ('processing', self.processing),
+                ('round trip', self.rtt)):
+            values.sort()
+            print('{}, us: {}, max {:.1f}'.format(
+                name,
+                ', '.join(
+                    'p{} {:.1f}'.format(pct, percentile(values, pct) / NS_IN_USEC)
+                    for pct in PERCENTILES
+                ),
+                values[-1] / NS_IN_USEC if values else 0
+            ))
+
+def main():
+    parser = ArgumentParser(
+        description='Load generator and accuracy benchmark for sntp.py.',
+        epilog='Usage example: sntp_load.py -r 20000 -d 10 -s 30'
+    )
+    parser.add_argument(
+        'server', type=str, nargs='?', default='127.0.0.1',
+        help='NTP server address. Default: 127.0.0.1'
+    )
+    parser.add_argument(
+        '-p', metavar='port', type=int, default=sntp.PURT,
+        help='NTP server port. Default: {}'.format(sntp.PURT)
+    )
+    parser.add_argument(
+        '-r', metavar='rate', type=int, default=10000,
+        help='requests per second. Default: 10000'
+    )
+    parser.add_argument(
+        '-d', metavar='duration', type=float, default=10,
+        help='test duration in seconds. Default: 10'
+    )
+    parser.add_argument(
+        '-n', metavar='sockets', type=int, default=64,
+        help='number of source ports. Default: 64'
+    )
+    parser.add_argument(
+        '-v', metavar='version', type=int, default=4,
+        help='NTP version in requests. Default: 4'
+    )
+    parser.add_argument(
+        '-s', metavar='shift', type=int, default=0,
+        help='time shift the server was started with, in seconds. Default: 0'
+    )
+    args = parser.parse_args()
+
+    with LoadGenerator(args.server, args.p, args.n, args.v, args.s) as generator:
+        try:
+            generator.run(args.r, args.d)
+        except KeyboardInterrupt:
+            pass
+        generator.report()
+
+if __name__ == '__main__':
+    main()
@@ -1,39 +1,104 @@
 import struct
 import socket
+import sys
+import select
+import asyncio
+import bisect
+import json
+from array import array
+import os.path
+import random
+import time
 import argparse
 import re
+import errno
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-IP_RE = re.compile(r'\d{1,3}')
 REFERRAL_RE = re.compile(r'refer:[^\w]+(.+)')
 AS_RE = re.compile(r'origin:[^\w]+(\w+)')
 COUNTRY_RE = re.compile(r'country:[^\w]+(\w+)')
 NETNAME_RE = re.compile(r'netname:[^\w]+(\w+)')
+INETNUM_RE = re.compile(
+    r'(?:inetnum|NetRange):\s*(\d+\.\d+\.\d+\.\d+)\s*-\s*(\d+\.\d+\.\d+\.\d+)'
+)
+ROUTE_RE = re.compile(r'(?:route|CIDR):\s*(\d+\.\d+\.\d+\.\d+/\d+)')
 DEFAULT_WHOIS_SERVER = 'whois.ripe.net'
 WHOIS_PORT = 43
+WHOIS_TIMEOUT = 10
+# сколько одновременных запросов можно слать одному WHOIS серверу
+WHOIS_SERVER_CONCURRENCY = 4
+WHOIS_CACHE_FILE = os.path.expanduser('~/.tracert_whois_cache.json')
+# через сколько секунд запись кэша считается устаревшей
+WHOIS_CACHE_TTL = 7 * 24 * 3600
+# сети крупнее этой в кэш не попадают целиком - скорее всего это блок
+# регистратора, а не сеть провайдера
+MIN_CACHED_PREFIX = 8
 IPV4_PACKET_LEN = 20
-PRIVATE_IP_RANGES = (
-    ((10, 0, 0, 0), (10, 255, 255, 255)),
-    ((172, 16, 0, 0), (172, 31, 255, 255)),
-    ((192, 168, 0, 0), (192, 168, 255, 255))
+ICMP_ECHO_REPLY = 0
+ICMP_DEST_UNREACH = 3
+ICMP_ECHO_REQUEST = 8
+ICMP_TIME_EXCEEDED = 11
+# пометки для кодов Destination Unreachable, как у traceroute
+UNREACH_MARKS = {
+    0: '!N', 1: '!H', 2: '!P', 4: '!F', 5: '!S',
+    9: '!X', 10: '!X', 13: '!X', 14: '!V', 15: '!C'
+}
+DEFAULT_TIMEOUT = 3
+DEFAULT_PROBES = 3
+DEFAULT_CONCURRENCY = 32
+# сколько имен из списка целей разрешается одновременно
+RESOLVE_WORKERS = 8
+# если буфер отправки сокета полон, столько раз ждем и пробуем снова
+SEND_RETRIES = 3
+SEND_BACKOFF = 0.05
+# сколько последних проб на хоп помнит режим мониторинга
+DEFAULT_HISTORY = 100
+# специальные сети, для которых WHOIS не нужен
+RESERVED_NETWORKS = (
+    ('0.0.0.0/8', 'this network'),
+    ('10.0.0.0/8', 'private address'),
+    ('100.64.0.0/10', 'shared address (CGN)'),
+    ('127.0.0.0/8', 'loopback'),
+    ('169.254.0.0/16', 'link-local'),
+    ('172.16.0.0/12', 'private address'),
+    ('192.0.0.0/24', 'IETF protocol assignments'),
+    ('192.0.2.0/24', 'documentation'),
+    ('192.168.0.0/16', 'private address'),
+    ('198.18.0.0/15', 'benchmarking'),
+    ('198.51.100.0/24', 'documentation'),
+    ('203.0.113.0/24', 'documentation'),
+    ('224.0.0.0/4', 'multicast'),
+    ('240.0.0.0/4', 'reserved')
 )
 
+class RawSocketPermissionError(Exception):
+    '''
+    Raw сокет для ICMP не открылся: нужны права root.
+    '''
+    pass
+
 class TraceInfo(object):
     def __init__(self, ttl, addr, is_target=False):
         self.addr = addr
         self.ttl = ttl
         self.is_target = is_target
+        # пометка Destination Unreachable (!H, !N, ...), если он пришел
+        self.unreachable = None
+        # время ответа на каждую пробу, None - ответа не было
+        self.rtts = []
 
 class ICMP(object):
     @staticmethod
-    def construct():
+    def construct(ident=0x3a00, seq=0x0100):
         '''
         Конструирует ICMP Echo Request пакет.
         '''
         #type 8 code 0 - echo request
         type_ = b'\x08\x00'
         checksum = b'\x00\x00'
-        # случайные индентификатор, номер последовательности, данные
-        data = b'\x3a\x00\x01\x00make me a sandwhich'
+        # индентификатор, номер последовательности, данные
+        data = struct.pack('>HH', ident, seq) + b'make me a sandwhich'
         checksum = ICMP.checksum(type_ + checksum + data)
         return type_ + struct.pack('>H', checksum) + data
 
@@ -44,146 +109,924 @@ class ICMP(object):
         '''
         return data[0], data[1]
 
+    @staticmethod
+    def parse_reply(packet):
+        '''
+        Разбирает IP пакет с raw сокета. Если это ответ на наш Echo Request,
+        возвращает тип и код ответа, идентификатор и номер последовательности
+        пробы. Echo Reply несет их сам, а Time Exceeded и Destination
+        Unreachable цитируют заголовок IP и первые 8 байт исходного пакета.
+        '''
+        ihl = (packet[0] & 0xf) * 4
+        if len(packet) < ihl + 8:
+            return None
+        type_, code = packet[ihl], packet[ihl + 1]
+        if type_ == ICMP_ECHO_REPLY:
+            return (type_, code) + struct.unpack('>HH', packet[ihl + 4:ihl + 8])
+        if type_ not in (ICMP_TIME_EXCEEDED, ICMP_DEST_UNREACH):
+            return None
+        inner = packet[ihl + 8:]
+        if len(inner) < IPV4_PACKET_LEN or inner[9] != socket.IPPROTO_ICMP:
+            return None
+        inner_ihl = (inner[0] & 0xf) * 4
+        if len(inner) < inner_ihl + 8 or inner[inner_ihl] != ICMP_ECHO_REQUEST:
+            return None
+        return (type_, code) + struct.unpack('>HH', inner[inner_ihl + 4:inner_ihl + 8])
+
     @staticmethod
     def checksum(data):
-        size = len(data)
-        checksum = 0
-        pointer = 0
+        '''
+        Дополнение до единицы суммы 16-битных слов. Слова складываются
+        одним sum по array, без цикла по байтам. Такая сумма не зависит от
+        порядка байт, поэтому слова складываются как есть, а переставляются
+        байты только в результате.
+        '''
+        if len(data) % 2:
+            data = bytes(data) + b'\x00'
+        checksum = fold(sum(array('H', data)))
+        if sys.byteorder == 'little':
+            checksum = ((checksum & 0xff) << 8) | (checksum >> 8)
+        return (~checksum) & 0xFFFF
 
-        while size > 1:
-            checksum += data[pointer]*256 + data[pointer+1]
-            size -= 2
-            pointer += 2
-        if size:
-            checksum += 256*data[pointer]
+def fold(checksum):
+    '''
+    Сворачивает сумму в 16 бит, перенося старшие разряды в младшие.
+    '''
+    while checksum >> 16:
+        checksum = (checksum & 0xffff) + (checksum >> 16)
+    return checksum
 
-        checksum = (checksum >> 16) + (checksum & 0xffff)
-        checksum += checksum >> 16
+class EchoFactory(object):
+    '''
+    Собирает Echo Request пакеты по заготовке. Для каждой пробы меняются
+    только идентификатор, номер последовательности и метка времени в
+    данных, поэтому контрольная сумма не считается заново по всему пакету:
+    к заранее посчитанной сумме заготовки прибавляются новые слова (RFC 1624).
+    Пакет собирается в одном буфере, следующий вызов build его перезапишет.
+    '''
+    # тип, код, контрольная сумма, идентификатор, номер, время в нс
+    HEADER = struct.Struct('>BBHHHQ')
 
-        return (~checksum) & 0xFFFF
+    def __init__(self, payload=b'make me a sandwhich'):
+        self.packet = bytearray(self.HEADER.size) + payload
+        self.HEADER.pack_into(self.packet, 0, ICMP_ECHO_REQUEST, 0, 0, 0, 0, 0)
+        self.base = (~ICMP.checksum(self.packet)) & 0xffff
 
-def is_ip_private(address):
-    nums = IP_RE.findall(address)
-    for range_ in PRIVATE_IP_RANGES:
-        in_range = 0
-        for i, num in enumerate(nums):
-            if int(num) >= range_[0][i] and int(num) <= range_[1][i]:
-                in_range += 1
-        if in_range == 4:
-            return True
-    return False
-
-def whois(address):
-    '''
-    Сначала обращаемся к DEFAULT_WHOIS_SERVER. Если на нем не оказалось
-    информации о стране и автономной системе, спрашиваем refer.
-    За имя сети считается доменное имя, получаемое через DNS.
-    '''
-    country = ''
-    a_system = ''
-    netname = ''
-
-    whois_server = DEFAULT_WHOIS_SERVER
-
-    while True:
-        s = socket.create_connection((whois_server, WHOIS_PORT))
-
-        s.sendall(address.encode('ascii')+b'\r\n')
-        answer = bytearray()
-        buf = b'stub'
-        while buf:
-            buf = s.recv(4096)
-            answer += buf
-        answer = answer.decode('utf8')
-
-        match = COUNTRY_RE.search(answer)
-        if match:
-            country = match.group(1)
-        match = AS_RE.search(answer)
-        if match:
-            a_system = match.group(1)
-        match = NETNAME_RE.search(answer)
-        if match:
-            netname = match.group(1)
-        if a_system and country and netname:
-            break
-        else:
-            #print(answer)
-            match = REFERRAL_RE.search(answer)
-            #print(match)
-            if match:
-                whois_server = match.group(1)
+    def build(self, ident, seq, timestamp):
+        checksum = self.base + ident + seq + \
+            (timestamp >> 48) + ((timestamp >> 32) & 0xffff) + \
+            ((timestamp >> 16) & 0xffff) + (timestamp & 0xffff)
+        checksum = (~fold(checksum)) & 0xffff
+        self.HEADER.pack_into(
+            self.packet, 0, ICMP_ECHO_REQUEST, 0, checksum, ident, seq, timestamp
+        )
+        return self.packet
+
+def ip_to_int(address):
+    return struct.unpack('>I', socket.inet_aton(address))[0]
+
+def int_to_ip(ip):
+    return socket.inet_ntoa(struct.pack('>I', ip))
+
+def parse_prefix(prefix):
+    '''
+    'a.b.c.d/n' -> (номер первого адреса сети, длина префикса).
+    '''
+    addr, length = prefix.split('/')
+    length = int(length)
+    mask = (0xffffffff << (32 - length)) & 0xffffffff
+    return ip_to_int(addr) & mask, length
+
+def split_range(first, last):
+    '''
+    Разбивает диапазон адресов на минимальный набор префиксов:
+    каждый раз берется самый большой выровненный блок с начала диапазона.
+    '''
+    while first <= last:
+        size = first & -first if first else 1 << 32
+        while size > last - first + 1:
+            size >>= 1
+        yield first, 33 - size.bit_length()
+        first += size
+
+class PrefixIndex(object):
+    '''
+    Поиск самого длинного префикса IPv4, содержащего адрес. Для каждой
+    длины префикса хранится словарь "номер сети" -> значение, где номер
+    сети - это адрес в виде числа, сдвинутый на 32 - длина. Поиск - это
+    не больше 33 обращений к словарю.
+    '''
+    def __init__(self):
+        self.tables = {}
+        self.lengths = []
+
+    def add(self, network, length, value):
+        if length not in self.tables:
+            self.tables[length] = {}
+            self.lengths = sorted(self.tables, reverse=True)
+        self.tables[length][network >> (32 - length)] = value
+
+    def add_range(self, first, last, value):
+        for network, length in split_range(first, last):
+            self.add(network, length, value)
+
+    def lookup(self, ip):
+        for length in self.lengths:
+            value = self.tables[length].get(ip >> (32 - length))
+            if value is not None:
+                return value
+        return None
+
+RESERVED_INDEX = PrefixIndex()
+for prefix, description in RESERVED_NETWORKS:
+    RESERVED_INDEX.add(*parse_prefix(prefix), description)
+
+def reserved_description(address):
+    '''
+    Для частных и зарезервированных адресов возвращает, что это за сеть,
+    для остальных - None.
+    '''
+    return RESERVED_INDEX.lookup(ip_to_int(address))
+
+def flatten_ranges(ranges):
+    '''
+    Разрезает пересекающиеся диапазоны (первый, последний, значение) на
+    непересекающиеся куски по возрастанию. Внутри вложенного диапазона
+    действует его значение, как у самого длинного префикса, а снаружи
+    снова значение объемлющего.
+    '''
+    flat = []
+    # объемлющие диапазоны, самый вложенный сверху
+    stack = []
+    # первый адрес, еще не попавший в flat
+    pos = 0
+    for first, last, value in sorted(ranges, key=lambda x: (x[0], -x[1])):
+        while stack and stack[-1][1] < first:
+            _, end, outer = stack.pop()
+            if pos <= end:
+                flat.append((pos, end, outer))
+                pos = end + 1
+        if stack and pos < first:
+            flat.append((pos, first - 1, stack[-1][2]))
+        pos = first
+        stack.append((first, last, value))
+    while stack:
+        _, end, outer = stack.pop()
+        if pos <= end:
+            flat.append((pos, end, outer))
+            pos = end + 1
+    return flat
+
+class RangeIndex(object):
+    '''
+    Диапазоны адресов в отсортированных массивах начал и концов; поиск -
+    двоичный поиск по началам. Вложенные диапазоны (8.0.0.0/9 и
+    8.8.8.0/24) при добавлении разрезаются flatten_ranges. Подходит для
+    таблиц IP -> ASN на сотни тысяч записей: каждая запись - это два
+    числа в array и ссылка на общий для всей AS кортеж.
+    '''
+    def __init__(self):
+        self.starts = array('I')
+        self.ends = array('I')
+        self.values = []
+
+    def __len__(self):
+        return len(self.values)
+
+    def extend(self, ranges):
+        '''
+        Добавляет (первый, последний, значение) и перестраивает индекс.
+        Новые диапазоны перекрывают старые такие же.
+        '''
+        merged = flatten_ranges(list(zip(self.starts, self.ends, self.values)) + list(ranges))
+        self.starts = array('I', (x[0] for x in merged))
+        self.ends = array('I', (x[1] for x in merged))
+        self.values = [x[2] for x in merged]
+
+    def lookup(self, ip):
+        idx = bisect.bisect_right(self.starts, ip) - 1
+        if idx >= 0 and ip <= self.ends[idx]:
+            return self.values[idx]
+        return None
+
+def load_asn_database(filename):
+    '''
+    Загружает таблицу IP -> (AS, страна, имя) для разметки хопов без сети.
+    Понимает ip2asn-v4.tsv с iptoasn.com (первый адрес, последний адрес,
+    номер AS, страна, описание через табуляцию) и CSV вида
+    "префикс,AS,страна,имя". Префиксы могут быть вложенными: адрес
+    получает AS самого длинного из них.
+    '''
+    ranges = []
+    # одинаковые кортежи хранятся один раз
+    values = {}
+    with open(filename, encoding='utf8', errors='replace') as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if not line or line.startswith('#'):
+                continue
+            if '\t' in line:
+                first, last, asn, country, name = (line.split('\t') + [''] * 5)[:5]
+                if asn == '0':
+                    # iptoasn так помечает немаршрутизируемые диапазоны
+                    continue
+                first, last = ip_to_int(first), ip_to_int(last)
             else:
+                prefix, asn, country, name = (line.split(',') + [''] * 4)[:4]
+                first, length = parse_prefix(prefix)
+                last = first + (1 << (32 - length)) - 1
+            if not asn.upper().startswith('AS'):
+                asn = 'AS' + asn
+            value = (asn, country, name.split()[0] if name else '')
+            ranges.append((first, last, values.setdefault(value, value)))
+    index = RangeIndex()
+    index.extend(ranges)
+    return index
+
+def parse_whois(answer, info):
+    '''
+    Дополняет info = [AS, страна, имя сети] тем, что нашлось в ответе.
+    Возвращает сервер из refer, если он есть.
+    '''
+    for idx, regexp in enumerate((AS_RE, COUNTRY_RE, NETNAME_RE)):
+        match = regexp.search(answer)
+        if match:
+            info[idx] = match.group(1)
+    match = REFERRAL_RE.search(answer)
+    return match.group(1) if match else None
+
+def intersect_ranges(a, b):
+    if a is None:
+        return b
+    return max(a[0], b[0]), min(a[1], b[1])
+
+def parse_whois_network(answer, ip):
+    '''
+    Возвращает самый узкий диапазон адресов (первый, последний) с ip, к
+    которому относится ответ WHOIS, или None. В ответе RIPE обычно есть
+    и агрегированный route (/16), и выделенный клиенту inetnum (/24):
+    страна и имя сети берутся из inetnum, поэтому и запоминать их можно
+    только для пересечения диапазонов, а не для всего route.
+    '''
+    network = None
+    for match in ROUTE_RE.finditer(answer):
+        first, length = parse_prefix(match.group(1))
+        found = first, first + (1 << (32 - length)) - 1
+        if found[0] <= ip <= found[1]:
+            network = intersect_ranges(network, found)
+    for match in INETNUM_RE.finditer(answer):
+        found = ip_to_int(match.group(1)), ip_to_int(match.group(2))
+        if found[0] <= ip <= found[1]:
+            network = intersect_ranges(network, found)
+    return network
+
+class WhoisResolver(object):
+    '''
+    Асинхронный WHOIS с кэшем на диске. Ответ запоминается для всей сети
+    из inetnum/route, а не для одного адреса, так что соседние
+    маршрутизаторы одного провайдера в WHOIS уже не идут.
+    Одному серверу одновременно шлется не больше per_server запросов,
+    одинаковые одновременные запросы объединяются в один.
+    '''
+    def __init__(self, cache_file=WHOIS_CACHE_FILE, per_server=WHOIS_SERVER_CONCURRENCY):
+        self.cache_file = cache_file
+        self.per_server = per_server
+        self.index = PrefixIndex()
+        # префикс -> {'info': [AS, страна, имя сети], 'time': когда получено}
+        self.entries = {}
+        self.changed = False
+        self.limits = {}
+        self.in_flight = {}
+        self.load()
+
+    def load(self):
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        for prefix, entry in entries.items():
+            if now - entry['time'] < WHOIS_CACHE_TTL:
+                self.remember(*parse_prefix(prefix), entry['info'], entry['time'])
+
+    def save(self):
+        if not self.cache_file or not self.changed:
+            return
+        tmp = self.cache_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp, self.cache_file)
+        self.changed = False
+
+    def remember(self, network, length, info, when):
+        info = tuple(info)
+        self.index.add(network, length, info)
+        self.entries['{}/{}'.format(int_to_ip(network), length)] = {'info': info, 'time': when}
+
+    def limit(self, server):
+        if server not in self.limits:
+            self.limits[server] = asyncio.Semaphore(self.per_server)
+        return self.limits[server]
+
+    async def query(self, server, address):
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(server, WHOIS_PORT), WHOIS_TIMEOUT
+        )
+        try:
+            writer.write(address.encode('ascii') + b'\r\n')
+            answer = await asyncio.wait_for(reader.read(), WHOIS_TIMEOUT)
+        finally:
+            writer.close()
+        return answer.decode('utf8', 'replace')
+
+    async def resolve(self, address):
+        '''
+        Сначала спрашивает DEFAULT_WHOIS_SERVER. Если на нем не оказалось
+        информации о стране и автономной системе, идет по refer.
+        '''
+        ip = ip_to_int(address)
+        info = ['', '', '']
+        network = None
+        server = DEFAULT_WHOIS_SERVER
+        visited = {server}
+        while True:
+            async with self.limit(server):
+                # пока ждали очереди, сеть могли уже узнать по соседнему адресу
+                cached = self.index.lookup(ip)
+                if cached:
+                    return cached
+                answer = await self.query(server, address)
+            found = parse_whois_network(answer, ip)
+            if found:
+                network = intersect_ranges(network, found)
+            referral = parse_whois(answer, info)
+            if all(info) or not referral or referral in visited:
                 break
+            visited.add(referral)
+            server = referral
+
+        info = tuple(info)
+        now = time.time()
+        if network and network[1] - network[0] < 2 ** (32 - MIN_CACHED_PREFIX):
+            for prefix, length in split_range(*network):
+                self.remember(prefix, length, info, now)
+        else:
+            self.remember(ip, 32, info, now)
+        self.changed = True
+        return info
+
+    async def lookup(self, address):
+        cached = self.index.lookup(ip_to_int(address))
+        if cached:
+            return cached
+        if address not in self.in_flight:
+            self.in_flight[address] = asyncio.ensure_future(self.resolve(address))
+        try:
+            return await self.in_flight[address]
+        finally:
+            self.in_flight.pop(address, None)
 
-    return a_system, country, netname
+    async def lookup_many(self, addresses):
+        '''
+        Параллельно получает информацию по всем адресам. Возвращает
+        словарь адрес -> (AS, страна, имя сети); если запрос не удался -
+        адрес -> None.
+        '''
+        # семафоры привязаны к циклу событий, а на каждый вызов он новый
+        self.limits = {}
+        self.in_flight = {}
+        addresses = list(addresses)
+        results = await asyncio.gather(
+            *(self.lookup(addr) for addr in addresses), return_exceptions=True
+        )
+        return {
+            addr: None if isinstance(res, Exception) else res
+            for addr, res in zip(addresses, results)
+        }
+
+def annotate(hops, resolver, database=None):
+    '''
+    Описывает адреса всех хопов разом: зарезервированные и найденные
+    в локальной базе - без сетевых запросов, остальные - через WHOIS,
+    параллельно. Без resolver в WHOIS не ходим вовсе.
+    Возвращает словарь адрес -> описание.
+    '''
+    res = {}
+    unknown = []
+    for addr in {hop.addr for hop in hops if hop.addr}:
+        info = reserved_description(addr)
+        if info is None and database is not None:
+            found = database.lookup(ip_to_int(addr))
+            info = ', '.join(found) if found else None
+        if info is None:
+            unknown.append(addr)
+        res[addr] = info or 'unknown'
+    if resolver and unknown:
+        infos = asyncio.run(resolver.lookup_many(unknown))
+        resolver.save()
+        for addr, info in infos.items():
+            res[addr] = ', '.join(info) if info else 'whois failed'
+    return res
 
-def tracert(address, max_ttl):
+class Trace(object):
     '''
-    Алгоритм стандартный: увеличиваем TTL не выше max_ttl, пока не
-    достигнем назначения.
+    Состояние трассировки одного адреса. Каждая проба получает свой номер
+    последовательности, по нему ответ находит свой TTL, так что пробы
+    на все TTL можно отправлять одновременно.
     '''
-    # сокет без протокола транспортного уровня, 1 - номер протокола ICMP в IPv4
-    s = socket.socket(socket.AF_INET, socket.SOCK_RAW, 1)
-    s.settimeout(5)
-    packet = ICMP.construct()
+    def __init__(self, address, ident, max_ttl, probes):
+        self.address = address
+        self.ident = ident
+        self.max_ttl = max_ttl
+        self.probes = probes
+        self.hops = [TraceInfo(ttl, None) for ttl in range(1, max_ttl + 1)]
+        # номер последовательности -> (TTL, время отправки)
+        self.pending = {}
+        self.next_seq = 0
+        # последний хоп: назначение или маршрутизатор, ответивший
+        # Destination Unreachable
+        self.last_ttl = None
+        self.reported = 0
 
-    for i in range(1, max_ttl + 1):
-        # устанавливаем поле TTL в заголовке IPv4
-        s.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, i)
-        # порт 0, т.к. протокол транспортного уровня не задействован
-        s.sendto(packet, (address, 0))
+    def new_probe(self, ttl, now):
+        seq = self.next_seq
+        self.next_seq = (self.next_seq + 1) & 0xffff
+        self.pending[seq] = (ttl, now)
+        return seq
+
+    def on_reply(self, seq, addr, type_, code, now):
+        '''
+        Учитывает ответ на пробу. Назначение достигнуто только по Echo
+        Reply; Destination Unreachable тоже заканчивает трассировку, но
+        хоп лишь помечается, как у traceroute.
+        '''
+        probe = self.pending.pop(seq, None)
+        if not probe:
+            return
+        ttl, sent = probe
+        hop = self.hops[ttl - 1]
+        if hop.addr is None:
+            hop.addr = addr
+        hop.rtts.append(now - sent)
+        if type_ == ICMP_TIME_EXCEEDED:
+            return
+        if type_ == ICMP_ECHO_REPLY:
+            hop.is_target = True
+        else:
+            hop.unreachable = UNREACH_MARKS.get(code, '!<{}>'.format(code))
+        if self.last_ttl is None or ttl < self.last_ttl:
+            self.last_ttl = ttl
+
+    def expire(self, now, timeout):
+        '''
+        Считает потерянными пробы, ответ на которые ждется дольше timeout.
+        '''
+        for seq, (ttl, sent) in list(self.pending.items()):
+            if now - sent >= timeout:
+                del self.pending[seq]
+                self.hops[ttl - 1].rtts.append(None)
+
+    def ready(self):
+        '''
+        Отдает по порядку хопы, по всем пробам которых уже есть ответ
+        или таймаут. Хопы дальше назначения не отдаются.
+        '''
+        while not self.done:
+            hop = self.hops[self.reported]
+            if len(hop.rtts) < self.probes:
+                return
+            self.reported += 1
+            yield hop
+
+    @property
+    def done(self):
+        return self.reported >= (self.last_ttl or self.max_ttl)
+
+    @property
+    def results(self):
+        return self.hops[:self.reported]
+
+class HopStats(TraceInfo):
+    '''
+    Хоп в режиме мониторинга: помнит только последние history проб,
+    по ним и считается статистика.
+    '''
+    def __init__(self, ttl, history):
+        super().__init__(ttl, None)
+        self.rtts = deque(maxlen=history)
+
+    def stats(self):
+        replies = [rtt for rtt in self.rtts if rtt is not None]
+        sent = len(self.rtts)
+        res = {
+            'ttl': self.ttl,
+            'addr': self.addr,
+            'sent': sent,
+            'loss': round(100 * (sent - len(replies)) / sent, 1) if sent else 0,
+        }
+        if self.unreachable:
+            res['unreachable'] = self.unreachable
+        if not replies:
+            return res
+        # джиттер - среднее изменение задержки между соседними ответами
+        jitter = sum(
+            abs(cur - prev) for prev, cur in zip(replies, replies[1:])
+        ) / (len(replies) - 1) if len(replies) > 1 else 0
+        for name, value in (
+                ('last', replies[-1]),
+                ('avg', sum(replies) / len(replies)),
+                ('best', min(replies)),
+                ('worst', max(replies)),
+                ('jitter', jitter)):
+            res[name] = round(value * 1000, 3)
+        return res
+
+class Monitor(Trace):
+    '''
+    Непрерывная трассировка в духе mtr: пробы на все хопы уходят каждый
+    круг, статистика копится в кольцевых буферах на history проб, так что
+    память не растет, сколько бы мониторинг ни шел.
+    '''
+    def __init__(self, address, ident, max_ttl, history):
+        super().__init__(address, ident, max_ttl, history)
+        self.hops = [HopStats(ttl, history) for ttl in range(1, max_ttl + 1)]
+        self.rounds = 0
+
+    def on_reply(self, seq, addr, type_, code, now):
+        probe = self.pending.get(seq)
+        super().on_reply(seq, addr, type_, code, now)
+        if probe:
+            # маршрут может поменяться, показываем последний ответивший адрес
+            self.hops[probe[0] - 1].addr = addr
+
+    @property
+    def path(self):
+        return self.hops[:self.last_ttl or self.max_ttl]
+
+    def snapshot(self):
+        return {
+            'time': round(time.time(), 3),
+            'destination': self.address,
+            'rounds': self.rounds,
+            'hops': [hop.stats() for hop in self.path],
+        }
+
+class Tracer(object):
+    '''
+    Отправляет пробы и принимает ответы для трассировок через один raw
+    сокет. Ответы раскладываются по трассировкам по идентификатору ICMP.
+    '''
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        # сокет без протокола транспортного уровня, 1 - номер протокола ICMP в IPv4
         try:
-            answer, addr = s.recvfrom(1024)
-        except socket.timeout:
-            yield TraceInfo(i, None)
-            continue
-
-        type_, code = ICMP.parse(answer[20:])
-        # код 0 и тип 0 - echo reply. Отправляется в случае успешной доставки echo request.
-        # В противном случае будет сигнал о истекшем ttl.
-        if type_ == 0 and code == 0:
-            yield TraceInfo(i, addr[0], True)
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+        except PermissionError as e:
+            raise RawSocketPermissionError(e)
+        self.sock.setblocking(False)
+        self.timeout = timeout
+        self.traces = {}
+        self.next_ident = random.randint(0, 0xffff)
+        self.ttl = None
+        self.factory = EchoFactory()
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, address, max_ttl, probes=DEFAULT_PROBES, trace_class=Trace):
+        while self.next_ident in self.traces:
+            self.next_ident = (self.next_ident + 1) & 0xffff
+        trace = trace_class(address, self.next_ident, max_ttl, probes)
+        self.traces[trace.ident] = trace
+        self.next_ident = (self.next_ident + 1) & 0xffff
+        return trace
+
+    def remove(self, trace):
+        del self.traces[trace.ident]
+
+    def send(self, trace, ttl):
+        if self.ttl != ttl:
+            # устанавливаем поле TTL в заголовке IPv4
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, ttl)
+            self.ttl = ttl
+        seq = trace.new_probe(ttl, time.monotonic())
+        packet = self.factory.build(trace.ident, seq, time.monotonic_ns())
+        # пачки проб большие, буфер отправки может переполниться: ждем,
+        # пока он освободится; если так и не отправили, проба истечет
+        # по таймауту как потерянная
+        for _ in range(SEND_RETRIES):
+            try:
+                # порт 0, т.к. протокол транспортного уровня не задействован
+                self.sock.sendto(packet, (trace.address, 0))
+            except BlockingIOError:
+                select.select([], [self.sock], [], SEND_BACKOFF)
+                continue
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    raise
+                time.sleep(SEND_BACKOFF)
+                continue
+            # RTT считаем от фактической отправки
+            trace.pending[seq] = (ttl, time.monotonic())
             return
 
-        yield TraceInfo(i, addr[0])
+    def start(self, trace):
+        '''
+        Отправляет разом все пробы трассировки. Пробы на один TTL идут
+        в разных кругах, чтобы не попасть под ограничение частоты ICMP
+        на маршрутизаторе.
+        '''
+        for _ in range(trace.probes):
+            for ttl in range(1, trace.max_ttl + 1):
+                self.send(trace, ttl)
+
+    def poll(self, wait):
+        '''
+        Ждет ответов не дольше wait секунд, разбирает все пришедшие,
+        затем отмечает потерянными пробы старше таймаута.
+        '''
+        r, *_ = select.select([self.sock], [], [], wait)
+        while r:
+            try:
+                packet, addr = self.sock.recvfrom(65536)
+            except (BlockingIOError, InterruptedError):
+                break
+            now = time.monotonic()
+            reply = ICMP.parse_reply(packet)
+            if not reply:
+                continue
+            type_, code, ident, seq = reply
+            trace = self.traces.get(ident)
+            if trace:
+                trace.on_reply(seq, addr[0], type_, code, now)
+        now = time.monotonic()
+        for trace in self.traces.values():
+            trace.expire(now, self.timeout)
+
+def tracert(address, max_ttl, probes=DEFAULT_PROBES, timeout=DEFAULT_TIMEOUT):
+    '''
+    Отправляем пробы сразу на все TTL не выше max_ttl, по probes штук на
+    каждый, и отдаем хопы по порядку по мере получения ответов. Вся
+    трассировка занимает около timeout секунд.
+    '''
+    with Tracer(timeout) as tracer:
+        trace = tracer.add(socket.gethostbyname(address), max_ttl, probes)
+        tracer.start(trace)
+        while not trace.done:
+            tracer.poll(timeout)
+            yield from trace.ready()
+
+def monitor(address, max_ttl, interval, history=DEFAULT_HISTORY,
+            timeout=DEFAULT_TIMEOUT, rounds=0):
+    '''
+    Раз в interval секунд отправляет по пробе на каждый хоп до назначения
+    и перед каждым следующим кругом отдает Monitor со статистикой.
+    Пробы без ответа дольше timeout считаются потерянными. Если rounds
+    не 0, останавливается после rounds кругов, иначе работает бесконечно.
+    '''
+    with Tracer(timeout) as tracer:
+        path = tracer.add(address, max_ttl, history, Monitor)
+        next_round = time.monotonic()
+        while True:
+            if time.monotonic() >= next_round:
+                if path.rounds:
+                    yield path
+                if path.rounds == rounds and rounds:
+                    return
+                for hop in path.path:
+                    tracer.send(path, hop.ttl)
+                path.rounds += 1
+                # если отстали, следующий круг отсчитываем от текущего момента
+                next_round = max(next_round + interval, time.monotonic())
+            tracer.poll(max(0, next_round - time.monotonic()))
+
+def trace_many(addresses, max_ttl, probes=DEFAULT_PROBES, timeout=DEFAULT_TIMEOUT,
+               concurrency=DEFAULT_CONCURRENCY):
+    '''
+    Трассирует много адресов через один raw сокет и один цикл приема.
+    Одновременно идет не больше concurrency трассировок, как только одна
+    заканчивается, начинается следующая. Отдает пары (адрес, Trace) по мере
+    завершения; если адрес не удалось разрешить или на него не уходят
+    пробы (широковещательный адрес, нет маршрута), вместо Trace будет
+    исключение, а остальные адреса трассируются дальше.
+    Имена разрешаются заранее в пуле потоков, чтобы ожидание DNS не
+    задерживало прием ответов и не раздувало RTT.
+    '''
+    addresses = iter(addresses)
+    resolver = ThreadPoolExecutor(RESOLVE_WORKERS)
+    try:
+        with Tracer(timeout) as tracer:
+            active = {}
+            failed = []
+            # (адрес, future с результатом gethostbyname)
+            resolving = []
+
+            def fill():
+                while len(active) + len(resolving) < 2 * concurrency:
+                    address = next(addresses, None)
+                    if address is None:
+                        break
+                    resolving.append((address, resolver.submit(socket.gethostbyname, address)))
+                for item in list(resolving):
+                    if len(active) >= concurrency:
+                        return
+                    address, future = item
+                    if not future.done():
+                        continue
+                    resolving.remove(item)
+                    try:
+                        trace = tracer.add(future.result(), max_ttl, probes)
+                    except socket.gaierror as e:
+                        failed.append((address, e))
+                        continue
+                    try:
+                        tracer.start(trace)
+                    except OSError as e:
+                        tracer.remove(trace)
+                        failed.append((address, e))
+                        continue
+                    active[trace] = address
+
+            fill()
+            while active or failed or resolving:
+                for address, error in failed:
+                    yield address, error
+                failed.clear()
+                if not active:
+                    if resolving:
+                        wait([future for _, future in resolving], return_when=FIRST_COMPLETED)
+                        fill()
+                    continue
+                tracer.poll(timeout)
+                for trace, address in list(active.items()):
+                    for _ in trace.ready():
+                        pass
+                    if trace.done:
+                        tracer.remove(trace)
+                        del active[trace]
+                        yield address, trace
+                fill()
+    finally:
+        # трассировку могли прервать, не ждем оставшиеся имена
+        resolver.shutdown(wait=False, cancel_futures=True)
+
+def read_targets(filename):
+    '''
+    Читает адреса из файла, по одному в строке. Пустые строки и
+    строки, начинающиеся с #, пропускаются.
+    '''
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield line
 
-def print_trace_info(trace_info):
+def print_trace_info(trace_info, info):
+    rtts = ' '.join(
+        '{:.3f} ms'.format(rtt * 1000) if rtt is not None else '*'
+        for rtt in trace_info.rtts
+    )
     if not trace_info.addr:
-        print('TTL={}: * * *'.format(trace_info.ttl))
+        print('TTL={}: {}'.format(trace_info.ttl, rtts))
         return
 
-    if is_ip_private(trace_info.addr):
-        info = 'private address'
-    else:
-        info = ', '.join(whois(trace_info.addr))
-    print('TTL={}: {} [{}]'.format(trace_info.ttl, trace_info.addr, info))
+    if trace_info.unreachable:
+        rtts += ' ' + trace_info.unreachable
+    print('TTL={}: {} [{}] {}'.format(trace_info.ttl, trace_info.addr, info, rtts))
     if trace_info.is_target:
         print('Destination reached.')
 
+def print_trace(name, address, hops, resolver, database=None):
+    print('Destination address: {} ({})'.format(address, name))
+    infos = annotate(hops, resolver, database)
+    for trace_info in hops:
+        print_trace_info(trace_info, infos.get(trace_info.addr))
+    print()
+
+def monitor_path(address, args, resolver, database=None):
+    '''
+    Печатает снимки мониторинга по одному JSON на строку. Описания
+    запрашиваются только для новых адресов, так что WHOIS не задерживает
+    круги, когда маршрут устоялся.
+    '''
+    infos = {}
+    path = monitor(
+        socket.gethostbyname(address), args.m, args.monitor,
+        args.history, args.t, args.rounds
+    )
+    try:
+        for trace in path:
+            new = [hop for hop in trace.path if hop.addr and hop.addr not in infos]
+            if new:
+                infos.update(annotate(new, resolver, database))
+            snapshot = trace.snapshot()
+            for hop in snapshot['hops']:
+                if hop['addr']:
+                    hop['info'] = infos.get(hop['addr'])
+            print(json.dumps(snapshot), flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        path.close()
+
 def main():
     parser = argparse.ArgumentParser(
         description='Traceroute + whois.',
         epilog='Usage example: tracert.py 8.8.8.8 e1.ru -m 30'
     )
     parser.add_argument(
-        'address', type=str, nargs='+',
+        'address', type=str, nargs='*',
         help='addresses that you want to trace')
+    parser.add_argument(
+        '-f', metavar='file', type=str,
+        help='file with addresses to trace, one per line'
+    )
+    parser.add_argument(
+        '-c', metavar='concurrency', type=int, default=DEFAULT_CONCURRENCY,
+        help='how many addresses to trace at once. Default: {}'.format(DEFAULT_CONCURRENCY)
+    )
     parser.add_argument(
         '-m', metavar='max TTL', type=int, default=30,
         help='max TTL. Default: 30'
     )
+    parser.add_argument(
+        '-q', metavar='probes', type=int, default=DEFAULT_PROBES,
+        help='probes per hop. Default: {}'.format(DEFAULT_PROBES)
+    )
+    parser.add_argument(
+        '-t', metavar='timeout', type=float, default=DEFAULT_TIMEOUT,
+        help='seconds to wait for a reply. Default: {}'.format(DEFAULT_TIMEOUT)
+    )
+    parser.add_argument(
+        '--whois-cache', metavar='file', type=str, default=WHOIS_CACHE_FILE,
+        help='WHOIS cache file, empty string to disable. Default: {}'.format(WHOIS_CACHE_FILE)
+    )
+    parser.add_argument(
+        '--db', metavar='file', type=str,
+        help='local IP to ASN table (ip2asn-v4.tsv or "prefix,AS,country,name" CSV). '
+             'WHOIS is asked only about addresses missing from it'
+    )
+    parser.add_argument(
+        '--no-whois', action='store_true',
+        help='never ask WHOIS, annotate hops only from --db'
+    )
+    parser.add_argument(
+        '--monitor', metavar='interval', type=float,
+        help='probe every hop each interval seconds until interrupted '
+             'and print per-hop statistics as a JSON line every round'
+    )
+    parser.add_argument(
+        '--history', metavar='probes', type=int, default=DEFAULT_HISTORY,
+        help='probes per hop the --monitor statistics are computed over. '
+             'Default: {}'.format(DEFAULT_HISTORY)
+    )
+    parser.add_argument(
+        '--rounds', metavar='count', type=int, default=0,
+        help='stop --monitor after this many rounds, 0 - never. Default: 0'
+    )
     args = parser.parse_args()
 
-    for addr in args.address:
-        print('Destination address: {} ({})'.format(socket.gethostbyname(addr), addr))
-        try:
-            for trace_info in tracert(addr, args.m):
-                print_trace_info(trace_info)
-        except PermissionError:
-            print('You do not have enough permissions to perform this action. Use sudo.')
+    addresses = list(args.address)
+    if args.f:
+        addresses.extend(read_targets(args.f))
+    if not addresses:
+        parser.error('no addresses to trace')
+
+    database = load_asn_database(args.db) if args.db else None
+    resolver = None if args.no_whois else WhoisResolver(args.whois_cache)
+    try:
+        if args.monitor:
+            if len(addresses) != 1:
+                parser.error('--monitor takes exactly one address')
+            monitor_path(addresses[0], args, resolver, database)
             return
-        print()
+
+        if len(addresses) == 1:
+            # трассировка занимает около таймаута, так что хопы собираются
+            # целиком и WHOIS по ним идет параллельно
+            addr = addresses[0]
+            hops = list(tracert(addr, args.m, args.q, args.t))
+            print_trace(addr, socket.gethostbyname(addr), hops, resolver, database)
+            return
+
+        for addr, trace in trace_many(addresses, args.m, args.q, args.t, args.c):
+            if not isinstance(trace, Trace):
+                print('Couldn\'t trace {}: {}'.format(addr, trace))
+                print()
+                continue
+            print_trace(addr, trace.address, trace.results, resolver, database)
+    except RawSocketPermissionError:
+        print('You do not have enough permissions to perform this action. Use sudo.')
+    except OSError as e:
+        print('ERROR:', e)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,83 @@
+'''
+Микробенчмарк сборки ICMP пакетов в tracert.py: контрольная сумма
+циклом по байтам против суммы по array и ICMP.construct против
+EchoFactory с поправкой контрольной суммы.
+'''
+import os
+import time
+from argparse import ArgumentParser
+
+import tracert
+
+def legacy_checksum(data):
+    '''
+    Контрольная сумма в том виде, в каком она была до array.
+    '''
+    size = len(data)
+    checksum = 0
+    pointer = 0
+
+    while size > 1:
+        checksum += data[pointer]*256 + data[pointer+1]
+        size -= 2
+        pointer += 2
+    if size:
+        checksum += 256*data[pointer]
+
+    checksum = (checksum >> 16) + (checksum & 0xffff)
+    checksum += checksum >> 16
+
+    return (~checksum) & 0xFFFF
+
+def measure(func, count):
+    '''
+    Возвращает, сколько раз в секунду выполняется func.
+    '''
+    start = time.perf_counter()
+    for _ in range(count):
+        func()
+    return count / (time.perf_counter() - start)
+
+def compare(name, old, new, count):
+    old_rate = measure(old, count)
+    new_rate = measure(new, count)
+    print('{}: {:>12,.0f} -> {:>12,.0f} per second, {:.2f}x'.format(
+        name, old_rate, new_rate, new_rate / old_rate
+    ))
+
+def main():
+    parser = ArgumentParser(
+        description='Micro-benchmark of ICMP checksum and packet building.',
+        epilog='Usage example: tracert_bench.py -n 200000'
+    )
+    parser.add_argument(
+        '-n', metavar='count', type=int, default=100000,
+        help='iterations per measurement. Default: 100000'
+    )
+    args = parser.parse_args()
+
+    for size in (28, 64, 1500):
+        data = os.urandom(size)
+        assert legacy_checksum(data) == tracert.ICMP.checksum(data)
+        compare(
+            'checksum, {:>4} bytes'.format(size),
+            lambda: legacy_checksum(data), lambda: tracert.ICMP.checksum(data),
+            args.n
+        )
+
+    factory = tracert.EchoFactory()
+    assert tracert.ICMP.checksum(factory.build(1, 2, time.monotonic_ns())) == 0
+    seq = [0]
+
+    def construct():
+        seq[0] = (seq[0] + 1) & 0xffff
+        return tracert.ICMP.construct(0x3a00, seq[0])
+
+    def build():
+        seq[0] = (seq[0] + 1) & 0xffff
+        return factory.build(0x3a00, seq[0], time.monotonic_ns())
+
+    compare('echo request packet  ', construct, build, args.n)
+
+if __name__ == '__main__':
+    main()